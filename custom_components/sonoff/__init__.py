@@ -1,5 +1,6 @@
 import asyncio
 import logging
+import time
 
 import voluptuous as vol
 from homeassistant.components import zeroconf
@@ -18,7 +19,7 @@ from homeassistant.const import (
     MAJOR_VERSION,
     MINOR_VERSION,
 )
-from homeassistant.core import HomeAssistant, ServiceCall
+from homeassistant.core import HomeAssistant, ServiceCall, callback
 from homeassistant.exceptions import ConfigEntryAuthFailed, ConfigEntryNotReady
 from homeassistant.helpers import config_validation as cv
 from homeassistant.helpers.device_registry import async_get as device_registry
@@ -35,7 +36,12 @@ from .core.const import (
     CONF_RFBRIDGE,
     DOMAIN,
 )
-from .core.ewelink import SIGNAL_ADD_ENTITIES, SIGNAL_CONNECTED, XRegistry
+from .core.ewelink import (
+    LOCAL_CONCURRENCY,
+    SIGNAL_ADD_ENTITIES,
+    SIGNAL_CONNECTED,
+    XRegistry,
+)
 from .core.ewelink.camera import XCameras
 from .core.ewelink.cloud import APP, AuthError
 from .core.xutils import create_clientsession
@@ -210,9 +216,22 @@ async def async_setup_entry(hass: HomeAssistant, config_entry: ConfigEntry) -> b
         hass.data[DOMAIN][config_entry.entry_id] = registry = XRegistry(session)
 
     registry.cloud_retry = config_entry.options.get("cloud_retry", False)
+    registry.hedged = config_entry.options.get("hedged_send", False)
+    registry.local_pool.limit = config_entry.options.get(
+        "local_concurrency", LOCAL_CONCURRENCY
+    )
+    registry.write_window = 0 if config_entry.options.get("write_coalesce") else None
+    registry.local_decrypt = config_entry.options.get("decrypt_executor", False)
     mode = config_entry.options.get(CONF_MODE, "auto")
     data = config_entry.data
 
+    # seconds from setup start to each startup stage, for diagnostics
+    started = time.monotonic()
+    registry.startup = {}
+
+    def stage(name: str):
+        registry.startup[name] = round(time.monotonic() - started, 3)
+
     # if has cloud password and not auth
     if not registry.cloud.auth and data.get(CONF_PASSWORD):
         try:
@@ -231,6 +250,7 @@ async def async_setup_entry(hass: HomeAssistant, config_entry: ConfigEntry) -> b
                 if isinstance(e, AuthError):
                     raise ConfigEntryAuthFailed(e)
                 raise ConfigEntryNotReady(e)
+        stage("login")
 
     if not config_entry.update_listeners:
         config_entry.add_update_listener(async_update_options)
@@ -241,31 +261,85 @@ async def async_setup_entry(hass: HomeAssistant, config_entry: ConfigEntry) -> b
 
     # important to run before registry.setup_devices (for remote childs)
     await hass.config_entries.async_forward_entry_setups(config_entry, PLATFORMS)
+    stage("platforms")
 
     devices: list[dict] | None = None
     store = Store(hass, 1, f"{DOMAIN}/{config_entry.data['username']}.json")
 
+    registry.cloud.homes = config_entry.options.get("homes")
+    stored = await store.async_load()
+    stage("cache")
+
+    # Opt-in: setup entities from cache and load Cloud devices in background
+    cache_first = bool(
+        registry.cloud.auth and stored and config_entry.options.get("cache_first")
+    )
+
+    if cache_first:
+        devices = stored
+        _LOGGER.debug(f"{len(devices)} devices loaded from Cache first")
+
     # if auth OK - load devices from cloud
-    if registry.cloud.auth:
+    elif registry.cloud.auth:
         try:
-            homes = config_entry.options.get("homes")
-            devices = await registry.cloud.get_devices(homes)
+            devices = await registry.cloud.get_devices(registry.cloud.homes)
             _LOGGER.debug(f"{len(devices)} devices loaded from Cloud")
+            # fresh state, no need to resync on first connect
+            registry.cloud_resync = False
 
-            # store devices to cache
-            await store.async_save(devices)
+            # keep last known LAN hosts from cache
+            registry.restore_devices(devices, stored)
+
+            # store devices to cache, if they changed since last start
+            digests = await hass.async_add_executor_job(
+                lambda: [registry.devices_digest(i) for i in (devices, stored)]
+            )
+            if digests[0] != digests[1]:
+                await store.async_save(devices)
 
         except Exception as e:
             _LOGGER.warning("Can't load devices", exc_info=e)
 
     if not devices:
-        if devices := await store.async_load():
+        if devices := stored:
             _LOGGER.debug(f"{len(devices)} devices loaded from Cache")
 
     if devices:
+        # save last known LAN hosts and params on unload and Hass stop
+        cache = devices
+
+        @callback
+        def store_save(*args):
+            store.async_delay_save(lambda: registry.store_devices(cache), 0)
+
+        config_entry.async_on_unload(store_save)
+        config_entry.async_on_unload(
+            hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, store_save)
+        )
+
+        # Opt-in: add entities right away with last known availability, real
+        # availability comes with transports. Entities check it on init.
+        registry.restoring = bool(config_entry.options.get("progressive_start"))
+
         # we need to setup_devices before local.start
         devices = internal_unique_devices(config_entry.entry_id, devices)
         entities = registry.setup_devices(devices)
+
+        if cache_first:
+
+            async def cloud_diff():
+                # known devices get only changed params, new devices - entities
+                if new := await registry.resync_cloud():
+                    new = internal_unique_devices(config_entry.entry_id, new)
+                    registry.dispatcher_send(
+                        SIGNAL_ADD_ENTITIES, registry.setup_devices(new)
+                    )
+                    cache.extend(new)
+                store_save()
+
+            # also stops resync on first Cloud connect
+            registry.resync_task = hass.async_create_task(cloud_diff())
+        stage("devices")
     else:
         entities = None
 
@@ -277,14 +351,33 @@ async def async_setup_entry(hass: HomeAssistant, config_entry: ConfigEntry) -> b
 
     _LOGGER.debug(mode.upper() + " mode start")
 
+    async def transports_ready():
+        if registry.cloud.task:
+            # we get cloud connected signal even with a cloud error, so we won't
+            # hold Hass start event forever
+            await registry.cloud.dispatcher_wait(SIGNAL_CONNECTED)
+            stage("cloud")
+        elif registry.local.online:
+            # check last known hosts from cache or we hope that most of local
+            # devices will be discovered in 3 seconds
+            if not await registry.probe_local():
+                await asyncio.sleep(3)
+            stage("local")
+
+    if registry.restoring:
+        _LOGGER.debug(f"Add {len(entities)} entities")
+        registry.dispatcher_send(SIGNAL_ADD_ENTITIES, entities)
+        stage("entities")
+
+        async def restore_done():
+            await transports_ready()
+            registry.restore_done()
+
+        config_entry.async_on_unload(hass.async_create_task(restore_done()).cancel)
+        return True
+
     # at this moment we hold EVENT_HOMEASSISTANT_START event
-    if registry.cloud.task:
-        # we get cloud connected signal even with a cloud error, so we won't
-        # hold Hass start event forever
-        await registry.cloud.dispatcher_wait(SIGNAL_CONNECTED)
-    elif registry.local.online:
-        # we hope that most of local devices will be discovered in 3 seconds
-        await asyncio.sleep(3)
+    await transports_ready()
 
     # 1. We need add_entities after cloud or local init, so they won't be
     #    unavailable at init state
@@ -293,6 +386,7 @@ async def async_setup_entry(hass: HomeAssistant, config_entry: ConfigEntry) -> b
     if entities:
         _LOGGER.debug(f"Add {len(entities)} entities")
         registry.dispatcher_send(SIGNAL_ADD_ENTITIES, entities)
+        stage("entities")
 
     return True
 
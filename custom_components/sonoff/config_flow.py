@@ -8,7 +8,7 @@ from homeassistant.core import callback
 from homeassistant.helpers.aiohttp_client import async_get_clientsession
 
 from .core.const import CONF_COUNTRY_CODE, CONF_DEBUG, CONF_MODES, DOMAIN
-from .core.ewelink import XRegistryCloud
+from .core.ewelink import LOCAL_CONCURRENCY, XRegistryCloud
 from .core.ewelink.cloud import REGIONS
 
 
@@ -125,6 +125,14 @@ class OptionsFlowHandler(OptionsFlow):
                 vol.Optional(CONF_MODE, default="auto"): vol.In(CONF_MODES),
                 vol.Optional(CONF_DEBUG, default=False): bool,
                 vol.Optional("cloud_retry", default=False): bool,
+                vol.Optional("hedged_send", default=False): bool,
+                vol.Optional(
+                    "local_concurrency", default=LOCAL_CONCURRENCY
+                ): vol.All(vol.Coerce(int), vol.Range(min=1)),
+                vol.Optional("write_coalesce", default=False): bool,
+                vol.Optional("decrypt_executor", default=False): bool,
+                vol.Optional("cache_first", default=False): bool,
+                vol.Optional("progressive_start", default=False): bool,
                 vol.Optional("homes"): cv.multi_select(homes),
             },
             dict(self.config_entry.options),
@@ -109,20 +109,53 @@ def unwrap_cached_properties(attrs: dict):
     return attrs
 
 
+# (cls, cls MRO, base, frozen kwargs) => class made by spec
+SPEC_CACHE: dict[tuple, type] = {}
+
+
+def freeze(value):
+    """Hashable version of the spec kwarg value for SPEC_CACHE key."""
+    if isinstance(value, (list, tuple)):
+        return type(value), tuple(freeze(i) for i in value)
+    if isinstance(value, (set, frozenset)):
+        return type(value), frozenset(value)
+    if isinstance(value, dict):
+        return dict, frozenset((k, freeze(v)) for k, v in value.items())
+    return value
+
+
 def spec(cls, base: str = None, enabled: bool = None, **kwargs) -> type:
     """Make duplicate for cls class with changes in kwargs params.
 
     If `base` param provided - can change Entity base class for cls. So it can
     be added to different Hass domain.
+
+    Same params return the same class, so setup of the same models and reloads
+    don't create new classes.
     """
     if enabled is not None:
         kwargs["_attr_entity_registry_enabled_default"] = enabled
+
+    try:
+        # MRO in key because set_default_class can change bases of cls
+        key = (cls, cls.__mro__, base, freeze(kwargs))
+        return SPEC_CACHE[key]
+    except KeyError:
+        pass
+    except TypeError:
+        key = None  # unhashable kwarg value, don't cache
+
     if base:
         attrs = cls.__mro__[-len(XSwitch.__mro__) :: -1]
         attrs = {k: v for b in attrs for k, v in b.__dict__.items()}
         attrs = unwrap_cached_properties({**attrs, **kwargs})
-        return type(cls.__name__, DEVICE_CLASS[base], attrs)
-    return type(cls.__name__, (cls,), kwargs)
+        new_cls = type(cls.__name__, DEVICE_CLASS[base], attrs)
+    else:
+        new_cls = type(cls.__name__, (cls,), kwargs)
+
+    if key is not None:
+        SPEC_CACHE[key] = new_cls
+    return new_cls
 
 
 Switch1 = spec(XSwitches, channel=0, uid="1")
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 
 from homeassistant.helpers.device_registry import CONNECTION_NETWORK_MAC
@@ -38,6 +39,37 @@ NAMES = {
 }
 
 
+class XStateWriter:
+    """Collect entities with changed state and write them to Hass together.
+
+    One device message may come from LAN mDNS, LAN response and Cloud within a
+    few milliseconds. Each entity is written only once per flush.
+    """
+
+    def __init__(self):
+        self.dirty: dict[Entity, None] = {}
+        self.handle: asyncio.Handle | None = None
+
+    def schedule(self, entity: Entity, delay: float):
+        self.dirty[entity] = None
+        if self.handle is None:
+            loop = entity.hass.loop
+            if delay:
+                self.handle = loop.call_later(delay, self.flush)
+            else:
+                self.handle = loop.call_soon(self.flush)
+
+    def flush(self):
+        self.handle = None
+        dirty, self.dirty = self.dirty, {}
+        for entity in dirty:
+            if entity.hass:
+                entity._async_write_ha_state()
+
+
+WRITER = XStateWriter()
+
+
 class XEntity(Entity):
     event: bool = False  # if True - skip set_state on entity init
     params: set = {}
@@ -97,11 +129,19 @@ class XEntity(Entity):
         except Exception as e:
             _LOGGER.error(f"Can't init device: {device}", exc_info=e)
 
-        ewelink.dispatcher_connect(deviceid, self.internal_update)
+        # Entities with default internal_update only need messages with their
+        # params (and availability changes), others receive all messages.
+        if self.params and type(self).internal_update is XEntity.internal_update:
+            ewelink.dispatcher_connect(deviceid, self.internal_update, self.params)
+        else:
+            ewelink.dispatcher_connect(deviceid, self.internal_update)
 
         if parent := device.get("parent"):
             self._attr_device_info["via_device"] = (DOMAIN, parent["deviceid"])
-            ewelink.dispatcher_connect(parent["deviceid"], self.internal_parent_update)
+            # parent messages only change the available state
+            ewelink.dispatcher_connect(
+                parent["deviceid"], self.internal_parent_update, set()
+            )
 
     @property
     def suggested_object_id(self) -> str | None:
@@ -117,7 +157,7 @@ class XEntity(Entity):
 
     def internal_available(self) -> bool:
         ok = self.ewelink.can_cloud(self.device) or self.ewelink.can_local(self.device)
-        return ok
+        return ok or self.ewelink.can_restore(self.device)
 
     def internal_update(self, params: dict = None):
         available = self.internal_available()
@@ -132,7 +172,10 @@ class XEntity(Entity):
             change = True
 
         if change and self.hass:
-            self._async_write_ha_state()
+            if self.ewelink.write_window is None:
+                self._async_write_ha_state()
+            else:
+                WRITER.schedule(self, self.ewelink.write_window)
 
     def internal_parent_update(self, params: dict = None):
         self.internal_update(None)
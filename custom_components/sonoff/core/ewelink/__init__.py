@@ -1,19 +1,38 @@
 import asyncio
 from collections import deque
+import heapq
+import json
 import logging
+import random
 import time
+from typing import Coroutine
 
 from aiohttp import ClientSession
 
 from .base import (
+    SIGNAL_ALIVE,
+    SIGNAL_BREAKER,
     SIGNAL_CLOUD_ERROR,
     SIGNAL_CONNECTED,
     SIGNAL_UPDATE,
     XDevice,
     XRegistryBase,
+    XTaskPool,
+)
+from .cloud import (
+    CLOUD_PRIORITY_POLL,
+    CLOUD_PRIORITY_QUERY,
+    CLOUD_PRIORITY_RECONCILE,
+    CLOUD_PRIORITY_USER,
+    XRegistryCloud,
+)
+from .local import (
+    PRIORITY_COMMAND,
+    PRIORITY_PING,
+    PRIORITY_QUERY,
+    PRIORITY_REFRESH,
+    XRegistryLocal,
 )
-from .cloud import XRegistryCloud
-from .local import XRegistryLocal
 
 _LOGGER = logging.getLogger(__name__)
 
@@ -21,6 +40,49 @@ SIGNAL_ADD_ENTITIES = "add_entities"
 COMMAND_ERRORS_MAXLEN = 100
 RECONCILE_DELAY = 2
 LOCAL_TTL = 60
+LOCAL_PING = 59  # one second less than a minute
+LOCAL_PING_MAX = 120  # for devices that send mDNS messages by themselves
+LOCAL_PING_JITTER = 0.1  # part of interval, so pings don't go all together
+LOCAL_INTERVAL = 5
+LOCAL_CONCURRENCY = 16
+LOCAL_DECRYPT_QUEUE = 256  # max encrypted LAN messages waiting for executor
+LOCAL_DECRYPT_WORKERS = 2
+LOCAL_PROBE_TIMEOUT = 1
+# XDevice keys saved to the Store, other XDevice keys are runtime state
+STORE_KEYS = {
+    "deviceid",
+    "extra",
+    "name",
+    "params",
+    "brandName",
+    "productModel",
+    "online",
+    "apikey",
+    "devicekey",
+    "host",
+    "localtype",
+}
+BULK_WINDOW = 0.1
+# multichannel param => merge rule. Items are merged by outlet. With True the
+# batch starts from the current device list, because the device replaces the
+# whole list
+BULK_PARAMS = {"switches": False, "configure": True, "pulses": True}
+# params that don't change anything if the device already has this state
+REDUNDANT_PARAMS = {"switch", "lightswitch"}
+REDUNDANT_TTL = 60  # seconds, older device state is not trusted
+# only updates with these params confirm the state for is_redundant_command,
+# telemetry (power, rssi) can come between a command and its confirmation
+STATE_PARAMS = REDUNDANT_PARAMS | {"switches"}
+UPDATE_TTL = 2  # seconds to treat the same update from another transport as echo
+UPDATES_MAXLEN = 8
+
+# Cloud request priority by send_cloud origin, user commands are first
+CLOUD_PRIORITIES = {
+    "error-reconciliation": CLOUD_PRIORITY_RECONCILE,
+    "error-retry": CLOUD_PRIORITY_RECONCILE,
+    "post-update-query": CLOUD_PRIORITY_QUERY,
+    "poll": CLOUD_PRIORITY_POLL,
+}
 
 
 class XRegistry(XRegistryBase):
@@ -31,12 +93,41 @@ class XRegistry(XRegistryBase):
         super().__init__(session)
 
         self.devices: dict[str, XDevice] = {}
+        # parent deviceid => child devices, see setup_devices
+        self.children: dict[str, list[XDevice]] = {}
         self.cloud_locks: dict[str, asyncio.Lock] = {}
         self.cloud_pending: dict[str, dict] = {}
         self.cloud_error_tasks: dict[str, asyncio.Task] = {}
         self.cloud_errors: deque[dict] = deque(maxlen=COMMAND_ERRORS_MAXLEN)
+        # known params may be older than Cloud (loaded from cache or offline)
+        self.cloud_resync = True
+        self.resync_task: asyncio.Task | None = None
+        # Opt-in: use last known availability until transports start
+        self.restoring = False
+        # startup stage => seconds from setup start
+        self.startup: dict[str, float] = {}
         # Opt-in: a retry is safe only for explicit switch on/off commands.
         self.cloud_retry = False
+        # Opt-in: send safe commands through Cloud too if LAN is late
+        self.hedged = False
+        self.hedge_tasks: set[asyncio.Task] = set()
+        # seconds to collect commands to one device, see send_bulk
+        self.bulk_window = BULK_WINDOW
+        self.bulk_tasks: set[asyncio.Task] = set()
+        # seconds to trust the device state, see is_redundant_command
+        self.redundant_ttl = REDUNDANT_TTL
+        self.redundant_stats = {"skipped": 0, "sent": 0}
+        # Opt-in: seconds to collect entity state writes, 0 - one loop iteration
+        self.write_window: float | None = None
+        # (deadline, deviceid) heap for run_forever, see schedule_local
+        self.local_timers: list[tuple[float, str]] = []
+        self.local_wakeup = asyncio.Event()
+        # background LAN requests (pings and sensor refreshes)
+        self.local_pool = XTaskPool(LOCAL_CONCURRENCY)
+        # Opt-in: decrypt LAN messages in executor, see decrypt_local
+        self.local_decrypt = False
+        self.decrypt_pending: dict[str, list[dict]] = {}
+        self.decrypt_pool = XTaskPool(LOCAL_DECRYPT_WORKERS)
 
         self.cloud = XRegistryCloud(session)
         # Let cloud protocol logs resolve a device ID to its local friendly name.
@@ -48,6 +139,9 @@ class XRegistry(XRegistryBase):
         self.local = XRegistryLocal(session)
         self.local.dispatcher_connect(SIGNAL_CONNECTED, self.local_connected)
         self.local.dispatcher_connect(SIGNAL_UPDATE, self.local_update)
+        # update availability and connection sensor of the device
+        self.local.dispatcher_connect(SIGNAL_BREAKER, self.dispatcher_send)
+        self.local.dispatcher_connect(SIGNAL_ALIVE, self.local_seen)
 
     def setup_devices(self, devices: list[XDevice]) -> list:
         from ..devices import get_spec
@@ -55,7 +149,11 @@ class XRegistry(XRegistryBase):
         entities = []
 
         # Devices without parent will be first, so via_device option won't fail
-        devices = sorted(devices, key=lambda d: d.get("params", {}).get("parentid", ""))
+        childs = [d for d in devices if d.get("params", {}).get("parentid")]
+        devices = [d for d in devices if not d.get("params", {}).get("parentid")]
+        devices += childs
+
+        index = {d["deviceid"]: d for d in devices}
 
         for device in devices:
             did = device["deviceid"]
@@ -69,12 +167,8 @@ class XRegistry(XRegistryBase):
                 _LOGGER.debug(f"{did} UIID {uiid:04} | %s", device["params"])
 
                 if parentid := device["params"].get("parentid"):
-                    try:
-                        device["parent"] = next(
-                            d for d in devices if d["deviceid"] == parentid
-                        )
-                    except StopIteration:
-                        pass
+                    if parent := index.get(parentid):
+                        device["parent"] = parent
 
                 # at this moment entities can catch signals with device_id and
                 # update their states, but they can be added to hass later
@@ -82,24 +176,104 @@ class XRegistry(XRegistryBase):
 
                 self.devices[did] = device
 
+                if parent := device.get("parent"):
+                    self.children.setdefault(parent["deviceid"], []).append(device)
+
             except Exception as e:
                 _LOGGER.warning(f"{did} !! can't setup device", exc_info=e)
 
         return entities
 
+    @staticmethod
+    def store_devices(devices: list[XDevice]) -> list[dict]:
+        """Return devices for the Store with the last known LAN host, localtype
+        and params.
+        """
+        skip = XDevice.__annotations__.keys() - STORE_KEYS
+        cache = []
+        for device in devices:
+            device = {k: v for k, v in device.items() if k not in skip}
+            # params can be changed while the Store writes a file
+            device["params"] = device["params"].copy()
+            cache.append(device)
+        return cache
+
+    @staticmethod
+    def devices_digest(devices: list[dict] | None) -> int:
+        """Digest of the devices list to skip unchanged cache writes."""
+        return hash(json.dumps(devices, sort_keys=True, default=str))
+
+    @staticmethod
+    def restore_devices(devices: list[XDevice], cache: list[dict] | None):
+        """Restore the last known LAN host and localtype for Cloud devices."""
+        if not cache:
+            return
+        cache = {d["deviceid"]: d for d in cache if "host" in d}
+        for device in devices:
+            if cached := cache.get(device["deviceid"]):
+                # params for custom sensor
+                device["host"] = device["params"]["host"] = cached["host"]
+                if "localtype" in cached:
+                    device["localtype"] = cached["localtype"]
+
+    async def probe_local(self) -> int:
+        """Check the last known LAN hosts, so devices don't wait for mDNS.
+
+        Return the number of probed devices.
+        """
+
+        async def probe(device: XDevice):
+            ok = await self.local_pool.run(
+                self.local.send(
+                    device, timeout=LOCAL_PROBE_TIMEOUT, priority=PRIORITY_QUERY
+                ),
+                PRIORITY_QUERY,
+            )
+            # mDNS message can come first
+            if ok != "online" or "local" in device:
+                return
+            _LOGGER.debug(f"{device['deviceid']} !! Local4 | Device online")
+            device["local"] = True
+            device["localrecv"] = time.time()
+            self.local_alive(device, False)
+            self.dispatcher_send(device["deviceid"])
+
+        devices = [
+            d for d in self.devices.values() if "host" in d and "local" not in d
+        ]
+        if devices:
+            await asyncio.gather(*[probe(d) for d in devices])
+        return len(devices)
+
     @property
     def online(self) -> bool:
         return self.cloud.online is not None or self.local.online
 
     async def stop(self, *args):
         self.devices.clear()
+        self.children.clear()
         self.dispatcher.clear()
+        self.dispatcher_keys.clear()
 
         for task in self.cloud_error_tasks.values():
             task.cancel()
         self.cloud_error_tasks.clear()
         self.cloud_pending.clear()
         self.cloud_locks.clear()
+        self.local_timers.clear()
+        self.local_pool.cancel()
+        self.decrypt_pool.cancel()
+        self.decrypt_pending.clear()
+        for task in self.hedge_tasks:
+            task.cancel()
+        self.hedge_tasks.clear()
+        for task in self.bulk_tasks:
+            task.cancel()
+        self.bulk_tasks.clear()
+        if self.resync_task:
+            self.resync_task.cancel()
+            self.resync_task = None
+        self.restoring = False
 
         await self.cloud.stop()
         await self.local.stop()
@@ -115,7 +289,7 @@ class XRegistry(XRegistryBase):
         params_lan: dict = None,
         cmd_lan: str = None,
         query_cloud: bool = True,
-        timeout_lan: int = 1,
+        timeout_lan: float = None,
     ) -> None:
         """Send command to device with LAN and Cloud. Usual params are same.
 
@@ -127,8 +301,17 @@ class XRegistry(XRegistryBase):
         :param cmd_lan: optional if LAN command different
         :param query_cloud: optional query Cloud state after update state,
           ignored if params empty
-        :param timeout_lan: optional custom LAN timeout
+        :param timeout_lan: optional custom LAN timeout, by default it depends on
+          the device round-trip time if Cloud is available
         """
+        if params:
+            if self.is_redundant_command(device, params):
+                _LOGGER.debug(f"{device['deviceid']} !! skip redundant {params}")
+                self.redundant_stats["skipped"] += 1
+                return
+            self.redundant_stats["sent"] += 1
+            device["command_ts"] = time.monotonic()
+
         seq = await self.sequence()
 
         if "parent" in device:
@@ -143,22 +326,48 @@ class XRegistry(XRegistryBase):
         can_local = self.can_local(device)
         can_cloud = self.can_cloud(device)
 
-        if can_local and can_cloud:
+        priority = PRIORITY_COMMAND if params else PRIORITY_QUERY
+
+        if can_local and can_cloud and not self.local.allow(main_device):
+            # LAN of the device is failing, don't wait for it and check it in
+            # background
+            self.ping_local(main_device)
+            await self.send_cloud(device, params, query_cloud, seq)
+
+        elif can_local and can_cloud and self.hedged and self.is_safe_hedge(params):
+            await self.send_hedged(
+                device, main_device, params, params_lan, cmd_lan, query_cloud, seq
+            )
+
+        elif can_local and can_cloud:
             # try to send a command locally (wait no more than a second)
-            ok = await self.local.send(
-                main_device, params_lan or params, cmd_lan, seq, timeout_lan
+            ok = await self.local_pool.run(
+                self.local.send(
+                    main_device,
+                    params_lan or params,
+                    cmd_lan,
+                    seq,
+                    timeout_lan or self.local.timeout(main_device),
+                    priority,
+                ),
+                priority,
             )
 
             # otherwise send a command through the cloud
             if ok != "online":
                 ok = await self.send_cloud(device, params, query_cloud, seq)
                 if ok != "online":
-                    main_device["localping"] = 0  # instant local ping request
+                    self.ping_local(main_device)
 
         elif can_local:
-            ok = await self.local.send(main_device, params_lan or params, cmd_lan, seq)
+            ok = await self.local_pool.run(
+                self.local.send(
+                    main_device, params_lan or params, cmd_lan, seq, priority=priority
+                ),
+                priority,
+            )
             if ok != "online":
-                main_device["localping"] = 0  # instant local ping request
+                self.ping_local(main_device)
 
         elif can_cloud:
             await self.send_cloud(device, params, query_cloud, seq)
@@ -166,48 +375,134 @@ class XRegistry(XRegistryBase):
         else:
             return
 
-    async def send_bulk(self, device: XDevice, params: dict):
-        assert "switches" in params
+    async def send_hedged(
+        self,
+        device: XDevice,
+        main_device: XDevice,
+        params: dict | None,
+        params_lan: dict | None,
+        cmd_lan: str | None,
+        query_cloud: bool,
+        seq: str,
+    ):
+        """Send command through LAN and, if LAN is late, through Cloud too.
 
-        if "params_bulk" in device:
-            for new in params["switches"]:
-                for old in device["params_bulk"]["switches"]:
-                    # check on duplicates
-                    if new["outlet"] == old["outlet"]:
-                        old["switch"] = new["switch"]
+        Return after the first transport confirms the command. The other one is
+        finished in background.
+        """
+        local = self.hedge_task(
+            self.local_pool.run(
+                self.local.send(
+                    main_device,
+                    params_lan or params,
+                    cmd_lan,
+                    seq,
+                    self.local.timeout(main_device),
+                    PRIORITY_COMMAND if params else PRIORITY_QUERY,
+                ),
+                PRIORITY_COMMAND if params else PRIORITY_QUERY,
+            )
+        )
+        cloud = None
+
+        try:
+            delay = self.local.hedge_delay(main_device)
+            done, _ = await asyncio.wait([local], timeout=delay)
+            if not done or local.result() != "online":
+                cloud = self.hedge_task(self.send_cloud(device, params, False, seq))
+                pending = {local, cloud}
+                while pending:
+                    done, pending = await asyncio.wait(
+                        pending, return_when=asyncio.FIRST_COMPLETED
+                    )
+                    if any(task.result() == "online" for task in done):
                         break
-                else:
-                    device["params_bulk"]["switches"].append(new)
-        else:
-            device["params_bulk"] = params
+        finally:
+            # also if the caller is cancelled, requests are already sent
+            self.hedge_task(
+                self.send_hedged_done(
+                    device, main_device, local, cloud, bool(params and query_cloud)
+                )
+            )
+
+    def hedge_task(self, coro: Coroutine) -> asyncio.Task:
+        """Start a task that is cancelled on registry stop."""
+        task = asyncio.get_event_loop().create_task(coro)
+        self.hedge_tasks.add(task)
+        task.add_done_callback(self.hedge_tasks.discard)
+        return task
+
+    async def send_hedged_done(
+        self,
+        device: XDevice,
+        main_device: XDevice,
+        local: asyncio.Task,
+        cloud: asyncio.Task | None,
+        query: bool,
+    ):
+        if await local == "online":
+            # LAN will send new device state after update command, so the Cloud
+            # query is not needed
+            if cloud:
+                await cloud
+            return
+
+        self.ping_local(main_device)
 
-        await asyncio.sleep(0.1)
+        if await cloud == "online" and query:
+            await self.send_cloud(device, timeout=0, origin="post-update-query")
 
-        # this can be called from different threads/loops
-        # https://github.com/AlexxIT/SonoffLAN/issues/1368
-        if params := device.pop("params_bulk", None):
-            return await self.send(device, params)
+    async def send_bulk(self, device: XDevice, params: dict):
+        """Collect commands to the device during bulk_window and send them as
+        one command. All callers wait until this command is sent.
+
+        The batch is sent by its own task, so a cancelled caller doesn't drop
+        commands of other callers.
+        """
+        if bulk := device.get("params_bulk"):
+            self.merge_bulk(device, bulk["params"], params)
+            await asyncio.shield(bulk["task"])
+            return
+
+        device["params_bulk"] = bulk = {"params": {}}
+        self.merge_bulk(device, bulk["params"], params)
+
+        task = asyncio.get_event_loop().create_task(self.send_bulk_batch(device, bulk))
+        bulk["task"] = task
+        self.bulk_tasks.add(task)
+        task.add_done_callback(self.bulk_tasks.discard)
 
-    # TODO: Unify send_bulk and send_bulk_configure
-    async def send_bulk_configure(self, device: XDevice, params: dict):
-        assert "configure" in params
+        await asyncio.shield(task)
 
-        if "params_bulk" in device:
-            for new in params["configure"]:
-                for old in device["params_bulk"]["configure"]:
+    async def send_bulk_batch(self, device: XDevice, bulk: dict):
+        try:
+            await asyncio.sleep(self.bulk_window)
+        finally:
+            # new commands will start a new batch
+            if device.get("params_bulk") is bulk:
+                device.pop("params_bulk")
+        await self.send(device, bulk["params"])
+
+    @staticmethod
+    def merge_bulk(device: XDevice, bulk: dict, params: dict):
+        """Merge command params to the batch by BULK_PARAMS rules."""
+        for k, v in params.items():
+            if k not in BULK_PARAMS:
+                bulk[k] = v
+                continue
+
+            if k not in bulk:
+                current = device.get("params", {}).get(k) if BULK_PARAMS[k] else None
+                bulk[k] = [dict(i) for i in current or [] if isinstance(i, dict)]
+
+            for new in v:
+                for old in bulk[k]:
                     # check on duplicates
-                    if new["outlet"] == old["outlet"]:
-                        old["startup"] = new["startup"]
+                    if new["outlet"] == old.get("outlet"):
+                        old.update(new)
                         break
                 else:
-                    device["params_bulk"]["configure"].append(new)
-        else:
-            device["params_bulk"] = params
-
-        await asyncio.sleep(0.1)
-
-        if params := device.pop("params_bulk", None):
-            return await self.send(device, params)
+                    bulk[k].append(dict(new))
 
     async def send_cloud(
         self,
@@ -232,6 +527,10 @@ class XRegistry(XRegistryBase):
         if sequence is None:
             sequence = await self.sequence()
 
+        priority = CLOUD_PRIORITIES.get(
+            origin, CLOUD_PRIORITY_USER if params else CLOUD_PRIORITY_QUERY
+        )
+
         command = {
             "action": "update" if params else "query",
             "params": params.copy() if params else None,
@@ -261,7 +560,9 @@ class XRegistry(XRegistryBase):
                 if k not in ("params", "safe_retry", "started_monotonic")
             }
             try:
-                ok = await self.cloud.send(device, params, sequence, timeout)
+                ok = await self.cloud.send(
+                    device, params, sequence, timeout, priority
+                )
             finally:
                 self.cloud_pending.pop(sequence, None)
 
@@ -279,7 +580,12 @@ class XRegistry(XRegistryBase):
                     **self.cloud_context(device),
                 }
                 try:
-                    await self.cloud.send(device, sequence=query_sequence, timeout=0)
+                    await self.cloud.send(
+                        device,
+                        sequence=query_sequence,
+                        timeout=0,
+                        priority=CLOUD_PRIORITY_QUERY,
+                    )
                 finally:
                     self.cloud_pending.pop(query_sequence, None)
 
@@ -320,6 +626,11 @@ class XRegistry(XRegistryBase):
             params
         ) == 1
 
+    @staticmethod
+    def is_safe_hedge(params: dict | None) -> bool:
+        """Device can get a query or an explicit on/off command twice."""
+        return not params or XRegistry.is_safe_retry(params)
+
     @staticmethod
     def is_redundant_switch_command(device: XDevice, params: dict | None) -> bool:
         """Return true only for a known, already satisfied switch state."""
@@ -327,6 +638,38 @@ class XRegistry(XRegistryBase):
             device.get("params", {}).get("switch") == params["switch"]
         )
 
+    def is_redundant_command(self, device: XDevice, params: dict) -> bool:
+        """Return true if the device reported the same state after our last
+        command and not so long ago.
+        """
+        state_ts = device.get("state_ts")
+        if state_ts is None or time.monotonic() - state_ts > self.redundant_ttl:
+            return False
+        if device.get("command_ts", 0) >= state_ts:
+            return False  # command in progress or state not confirmed yet
+
+        state = device.get("params") or {}
+        for k, v in params.items():
+            if k in REDUNDANT_PARAMS:
+                if state.get(k) != v:
+                    return False
+            elif k == "switches":
+                outlets = {
+                    i.get("outlet"): i.get("switch")
+                    for i in state.get(k) or []
+                    if isinstance(i, dict)
+                }
+                if any(
+                    i.keys() != {"outlet", "switch"}
+                    or outlets.get(i["outlet"]) != i["switch"]
+                    for i in v
+                ):
+                    return False
+            else:
+                return False
+
+        return True
+
     @staticmethod
     def is_command_confirmed(device: XDevice, command: dict, sequence: str) -> bool:
         """Confirm that the reconciliation response reports the requested state."""
@@ -432,9 +775,57 @@ class XRegistry(XRegistryBase):
         for deviceid in self.devices.keys():
             self.dispatcher_send(deviceid)
 
+        if not self.cloud.online:
+            # we may miss updates while offline
+            self.cloud_resync = True
+        elif self.cloud_resync and not self.resync_task:
+            self.resync_task = asyncio.get_event_loop().create_task(
+                self.resync_cloud()
+            )
+
         # if not self.task:
         #     self.task = asyncio.create_task(self.run_forever())
 
+    async def resync_cloud(self) -> list[XDevice]:
+        """Fetch current state of all devices from Cloud and send only changes.
+        Return Cloud devices unknown to the registry.
+        """
+        try:
+            devices = await self.cloud.get_devices(self.cloud.homes)
+            self.cloud_resync = False
+            changed = sum(self.cloud_resync_device(item) for item in devices)
+            _LOGGER.debug(f"{changed} of {len(devices)} devices changed in Cloud")
+            return [item for item in devices if item["deviceid"] not in self.devices]
+        except Exception as e:
+            _LOGGER.warning("Can't resync devices", exc_info=e)
+            return []
+        finally:
+            self.resync_task = None
+
+    def cloud_resync_device(self, item: dict) -> bool:
+        """Apply the device state from Cloud devices list as Cloud updates."""
+        did = item["deviceid"]
+        device = self.devices.get(did)
+        if not device or "online" not in device:
+            return False
+
+        changed = False
+
+        online = item.get("online")
+        if online is not None and online != device["online"]:
+            self.cloud_update({"deviceid": did, "params": {"online": online}})
+            changed = True
+
+        state = device.get("params") or {}
+        params = {
+            k: v for k, v in (item.get("params") or {}).items() if state.get(k) != v
+        }
+        if params:
+            self.cloud_update({"deviceid": did, "params": params})
+            changed = True
+
+        return changed
+
     def local_connected(self):
         if not self.task:
             self.task = asyncio.create_task(self.run_forever())
@@ -448,6 +839,7 @@ class XRegistry(XRegistryBase):
 
         params = msg["params"]
         device["cloud_seq"] = seq = msg.get("sequence")
+        available = self.available_state(device)
 
         _LOGGER.debug(f"{did} <= Cloud3 | %s | {seq}", params)
 
@@ -455,18 +847,30 @@ class XRegistry(XRegistryBase):
         if "online" in params:
             device["online"] = params["online"]
             # check if LAN online after cloud status change
-            device["localping"] = 0  # instant local ping request
+            self.ping_local(device)
 
         # Fix bug - cloud sends `{"subDevRssi": 127}` even for offline devices
         elif device["online"] is False and params.keys() != {"subDevRssi"}:
             device["online"] = True
 
+        if "online" not in params and self.is_duplicate_update(
+            device, "cloud", seq, params, did
+        ):
+            if self.available_state(device) != available:
+                self.dispatcher_send(did)
+            return
+
         if "sledOnline" in params:
             device["params"]["sledOnline"] = params["sledOnline"]
 
         device["params"].update(params)
+        if "online" in params:
+            # the device could change state while offline
+            device.pop("state_ts", None)
+        elif params.keys() & STATE_PARAMS:
+            device["state_ts"] = time.monotonic()
 
-        self.dispatcher_send(did, params)
+        self.dispatcher_send_update(did, params, device, available)
 
     def local_update(self, msg: dict):
         mainid: str = msg["deviceid"]
@@ -498,6 +902,9 @@ class XRegistry(XRegistryBase):
             if "devicekey" not in device:
                 # this is known device with encrypted payload but without devicekey
                 return
+            if self.local_decrypt:
+                self.decrypt_local(device, msg)
+                return
             try:
                 # decrypt payload for known device with devicekey
                 params = self.local.decrypt_msg(msg, device["devicekey"])
@@ -510,77 +917,298 @@ class XRegistry(XRegistryBase):
             # DIY device is still connected to the ewelink account
             device.pop("devicekey")
 
+        self.local_update_params(device, msg, params)
+
+    def local_update_params(self, device: XDevice, msg: dict, params: dict):
+        mainid: str = msg["deviceid"]
         # realid can be different from mainid for SPM-4RELAY
         realid = msg.get("subdevid", mainid)
         tag = "Local3" if "host" in msg else "Local0"
         host = msg.get("host", "^^^")
-        device["local_seq"] = seq = msg.get("seq")
+        seq = msg.get("seq")
 
         _LOGGER.debug(f"{realid} <= {tag} | {host} | %s | {seq}", params)
 
-        if "params" in device:
-            device["params"].update(params)
-        else:
-            device["params"] = params
+        available = self.available_state(device)
 
         # we can get data from device, but without host
         if "host" in msg and device.get("host") != msg["host"]:
-            # params for custom sensor
-            device["host"] = params["host"] = msg["host"]
+            device["host"] = msg["host"]
             device["localtype"] = msg["localtype"]
 
-        ts = time.time()
+            if msg["localtype"] == "meter":
+                # SPM-Main childrens are polled through the parent
+                for child in self.children.get(device["deviceid"], ()):
+                    self.schedule_local(child)
+
+        # params for custom sensor, host can be restored from cache without it
+        if "host" in msg and device.get("params", {}).get("host") != msg["host"]:
+            params["host"] = msg["host"]
+
+        # duplicates still prove that the device is online
+        duplicate = self.is_duplicate_update(device, "local", seq, params, realid)
+        if not duplicate:
+            device["local_seq"] = seq
+            if "params" in device:
+                device["params"].update(params)
+            else:
+                device["params"] = params
+            if params.keys() & STATE_PARAMS:
+                device["state_ts"] = time.monotonic()
+
         device["local"] = True
-        device["localfail"] = 0
-        device["localping"] = ts + 59  # one second less than a minute
-        device["localrecv"] = ts
+        device["localrecv"] = time.time()
+        # only zeroconf messages have host, HTTP answers come without it
+        self.local_alive(device, "host" in msg)
+
+        if duplicate:
+            if self.available_state(device) != available:
+                self.dispatcher_send(realid)
+            return
 
-        self.dispatcher_send(realid, params)
+        self.dispatcher_send_update(realid, params, device, available)
 
         # send empty msg to main device for updating available flag
         if realid != mainid:
             self.dispatcher_send(mainid, None)
 
+    def decrypt_local(self, device: XDevice, msg: dict):
+        """Queue encrypted message to the executor.
+
+        A burst of mDNS announcements (HA start, Wi-Fi AP reboot) can contain
+        hundreds of encrypted messages. Messages of one device are decrypted
+        as a batch in the order they came and only one batch per device is in
+        progress.
+        """
+        if sum(map(len, self.decrypt_pending.values())) >= LOCAL_DECRYPT_QUEUE:
+            _LOGGER.debug(f"{msg['deviceid']} !! Decrypt queue is full")
+            self.decrypt_dropped(device, msg)
+            return
+
+        deviceid = device["deviceid"]
+        if deviceid in self.decrypt_pending:
+            self.decrypt_pending[deviceid].append(msg)
+            return
+
+        self.decrypt_pending[deviceid] = [msg]
+        self.decrypt_pool.create_task(self.decrypt_local_batch(device), 1)
+
+    def decrypt_dropped(self, device: XDevice, msg: dict):
+        """Zeroconf doesn't repeat an unchanged TXT record, so the dropped
+        message is forgotten and the device is pinged for its state.
+        """
+        deviceid = device["deviceid"]
+        self.local.last_txt.pop((deviceid, msg.get("subdevid", deviceid)), None)
+
+        if "local" not in device:
+            # first message from the device, run_forever needs LAN state
+            if "host" not in msg:
+                return
+            device.setdefault("host", msg["host"])
+            device.setdefault("localtype", msg["localtype"])
+            device.update(local=False, localfail=0, localrecv=0)
+
+        self.ping_local(device)
+
+    async def decrypt_local_batch(self, device: XDevice):
+        deviceid = device["deviceid"]
+        loop = asyncio.get_event_loop()
+        try:
+            while msgs := self.decrypt_pending.get(deviceid):
+                self.decrypt_pending[deviceid] = []
+                results = await loop.run_in_executor(
+                    None, self.local.decrypt_msgs, msgs, device["devicekey"]
+                )
+
+                for msg, params in zip(msgs, results):
+                    if isinstance(params, Exception):
+                        _LOGGER.debug("Can't decrypt message %s", msg, exc_info=params)
+                        continue
+                    # device can be removed while waiting for executor
+                    if self.devices.get(deviceid) is not device:
+                        return
+                    self.local_update_params(device, msg, params)
+        finally:
+            self.decrypt_pending.pop(deviceid, None)
+
+    @staticmethod
+    def is_duplicate_update(
+        device: XDevice, transport: str, seq, params: dict, realid: str
+    ) -> bool:
+        """Check update against a few recent updates of the device.
+
+        Duplicate is an update with the same sequence and params from the same
+        transport (mDNS repeats), or the same params from another transport a
+        moment later that don't change the known state (LAN and Cloud echo).
+        A LAN update with a lower sequence than a recent one of the same
+        (sub)device is stale, SPM-Main children have their own counters.
+        """
+        if not params:
+            return False
+
+        digest = hash((realid, json.dumps(params, sort_keys=True, default=str)))
+        ts = time.monotonic()
+        recent = device.setdefault("recent_updates", deque(maxlen=UPDATES_MAXLEN))
+        state = device.get("params") or {}
+
+        for r_transport, r_realid, r_seq, r_digest, r_ts in recent:
+            if transport == r_transport:
+                if seq is not None and seq == r_seq and digest == r_digest:
+                    return True
+                # a device reboot resets the counter, but takes longer than TTL
+                if (
+                    transport == "local"
+                    and realid == r_realid
+                    and ts - r_ts < UPDATE_TTL
+                ):
+                    try:
+                        if int(seq) < int(r_seq):
+                            return True
+                    except (TypeError, ValueError):
+                        pass
+            elif (
+                digest == r_digest
+                and ts - r_ts < UPDATE_TTL
+                and all(state.get(k) == v for k, v in params.items())
+            ):
+                return True
+
+        recent.append((transport, realid, seq, digest, ts))
+        return False
+
+    def available_state(self, device: XDevice) -> tuple[bool, bool]:
+        return bool(self.can_cloud(device)), bool(self.can_local(device))
+
+    def dispatcher_send_update(
+        self, did: str, params: dict, device: XDevice, available: tuple
+    ):
+        """Send params only to interested entities, unless availability of the
+        device has changed, in that case all entities should be updated.
+        """
+        if self.available_state(device) != available:
+            self.dispatcher_send(did, params)
+        else:
+            self.dispatcher_send_keys(did, params)
+
+    def schedule_local(self, device: XDevice, deadline: float = 0):
+        """Ask run_forever to check the device not later than deadline.
+
+        Each device keeps only its earliest deadline in `local_due`. Later heap
+        items for the same device are skipped when they are popped.
+        """
+        if deadline >= device.get("local_due", float("inf")):
+            return
+        device["local_due"] = deadline
+        heapq.heappush(self.local_timers, (deadline, device["deviceid"]))
+        if self.local_timers[0][0] == deadline:
+            self.local_wakeup.set()
+
+    def local_alive(self, device: XDevice, mdns: bool):
+        """Any message or answer from the device proves that it's online.
+
+        Each mDNS message doubles the ping interval up to LOCAL_PING_MAX, so the
+        devices that report by themselves are pinged less. A ping resets it.
+        """
+        interval = device.get("localinterval", LOCAL_PING)
+        if mdns:
+            device["localinterval"] = interval = min(interval * 2, LOCAL_PING_MAX)
+        jitter = random.uniform(1 - LOCAL_PING_JITTER, 1)
+        device["localfail"] = 0
+        device["localping"] = time.time() + interval * jitter
+        self.schedule_local(device, self.local_deadline(device))
+
+    def local_seen(self, deviceid: str, mdns: bool):
+        device = self.devices.get(deviceid)
+        # skip unknown devices and devices without LAN state (probe, DIY setup)
+        if not device or "local" not in device:
+            return
+        self.local_alive(device, mdns)
+        if not device["local"]:
+            # unchanged TXT record from the device that failed pings
+            device["local"] = True
+            _LOGGER.debug(f"{deviceid} !! Local4 | Device online")
+            self.dispatcher_send(deviceid)
+
+    def ping_local(self, device: XDevice):
+        device["localping"] = 0  # instant local ping request
+        self.schedule_local(device)
+
     async def run_forever(self):
+        for device in self.devices.values():
+            self.schedule_local(device)
+
+        timers = self.local_timers
         while True:
             ts = time.time()
-            for device in self.devices.values():
+            while timers and timers[0][0] <= ts:
+                deadline, did = heapq.heappop(timers)
+                device = self.devices.get(did)
+                # device removed or rescheduled to an earlier time
+                if not device or device.get("local_due") != deadline:
+                    continue
+                del device["local_due"]
                 try:
                     if "local" in device:
-                        self.update_local(device, ts)
+                        self.schedule_local(device, self.update_local(device, ts))
                     elif parent := device.get("parent"):
                         # Support childrens only for SPM-Main (128)
                         if parent.get("localtype") == "meter":
                             self.update_local_child(parent, device)
+                            self.schedule_local(device, ts + LOCAL_INTERVAL)
                 except Exception as e:
                     _LOGGER.warning("run_forever", exc_info=e)
-            await asyncio.sleep(5)
 
-    def update_local(self, device: XDevice, ts: float):
+            self.local_wakeup.clear()
+            try:
+                delay = timers[0][0] - ts if timers else None
+                await asyncio.wait_for(self.local_wakeup.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+    @staticmethod
+    def local_refresh(device: XDevice) -> tuple | None:
+        """Return command and params for sensors update of Power and TH devices."""
+        if device["localfail"] >= 3:  # no more than 3 times
+            return None
+        uiid = device["extra"]["uiid"]
+        # TH10R2 (15) and THR316D/THR320D (181) shouldn't be here, but anyway
+        if uiid in (15, 32, 181, 182, 190, 262, 277):
+            if led := device["params"].get("sledOnline"):
+                return "sledonline", {"sledOnline": led}
+        elif uiid == 126:
+            return "statistics", None
+        return None
+
+    def local_deadline(self, device: XDevice) -> float:
+        if self.local_refresh(device):
+            # one second less than 5 second
+            return min(device["localrecv"] + 4, device["localping"])
+        return device["localping"]
+
+    def update_local(self, device: XDevice, ts: float) -> float:
+        """Start due local requests and return the next deadline for device."""
         # 1. Update sensors data for Power and TH devices if we haven't received them
         #    for more than 5 seconds.
-        if (
-            ts >= device["localrecv"] + 4  # one second less than 5 second
-            and device["localfail"] < 3  # no more than 3 times
-        ):
-            uiid = device["extra"]["uiid"]
-            # TH10R2 (15) and THR316D/THR320D (181) shouldn't be here, but anyway
-            if uiid in (15, 32, 181, 182, 190, 262, 277):
-                if led := device["params"].get("sledOnline"):
-                    params = {"sledOnline": led}
-                    asyncio.create_task(self.send_local(device, "sledonline", params))
-                    return
-            elif uiid == 126:
-                asyncio.create_task(self.send_local(device, "statistics"))
-                return
+        if (refresh := self.local_refresh(device)) and ts >= device["localrecv"] + 4:
+            self.local_pool.create_task(
+                self.send_local(device, *refresh, PRIORITY_REFRESH), PRIORITY_REFRESH
+            )
+            return ts + LOCAL_INTERVAL
 
         # 2. Update local availability for all local devices (online and offline).
         if ts >= device["localping"]:
-            asyncio.create_task(self.send_local(device))
+            # the device was quiet for the whole interval
+            device["localinterval"] = LOCAL_PING
+            self.local_pool.create_task(self.send_local(device), PRIORITY_PING)
+            # check again when the ping is finished
+            return ts + LOCAL_INTERVAL
+
+        return self.local_deadline(device)
 
     def update_local_child(self, parent: XDevice | dict, device: XDevice):
         # 3. Update sensors data for SPM-Main childrens.
-        if parent["localfail"] >= 3:
+        # parent with cached localtype may be not found in LAN yet
+        if "local" not in parent or parent["localfail"] >= 3:
             return
         outlet = device.get("active_outlet", 0)
         device["active_outlet"] = outlet + 1 if outlet < 3 else 0
@@ -588,13 +1216,30 @@ class XRegistry(XRegistryBase):
             "subDevId": device["deviceid"],
             "uiActive": {"outlet": outlet, "time": 60},
         }
-        asyncio.create_task(self.send_local(parent, "uiActive", params))
+        self.local_pool.create_task(
+            self.send_local(parent, "uiActive", params, PRIORITY_REFRESH),
+            PRIORITY_REFRESH,
+        )
 
     def can_cloud(self, device: XDevice) -> bool:
         if not self.cloud.online:
             return False
         return device.get("online")
 
+    def can_restore(self, device: XDevice) -> bool:
+        """Last known availability from cache, only while transports start."""
+        if not self.restoring:
+            return False
+        return bool(device.get("online") or device.get("host"))
+
+    def restore_done(self):
+        """Switch to real availability from transports."""
+        if not self.restoring:
+            return
+        self.restoring = False
+        for deviceid in self.devices.keys():
+            self.dispatcher_send(deviceid)
+
     def can_local(self, device: XDevice) -> bool:
         if not self.local.online:
             return False
@@ -606,9 +1251,13 @@ class XRegistry(XRegistryBase):
         return device.get("local")
 
     async def send_local(
-        self, device: XDevice, command: str = None, params: dict = None
+        self,
+        device: XDevice,
+        command: str = None,
+        params: dict = None,
+        priority: int = PRIORITY_PING,
     ):
-        ok = await self.local.send(device, params, command)
+        ok = await self.local.send(device, params, command, priority=priority)
         if ok == "online":
             if not device["local"]:
                 device["local"] = True
@@ -616,8 +1265,7 @@ class XRegistry(XRegistryBase):
                 _LOGGER.debug(f"{did} !! Local4 | Device online")
                 self.dispatcher_send(did)
 
-            device["localfail"] = 0
-            device["localping"] = time.time() + 59
+            # localping is updated by local_alive
             return
 
         device["localfail"] += 1
@@ -632,4 +1280,4 @@ class XRegistry(XRegistryBase):
             _LOGGER.debug(f"{did} !! Local4 | Device offline")
             self.dispatcher_send(did)
 
-        device["localping"] = time.time() + 59
+        device["localping"] = time.time() + LOCAL_PING
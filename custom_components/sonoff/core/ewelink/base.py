@@ -1,12 +1,17 @@
 import asyncio
+from collections import deque
+import heapq
+import itertools
 import time
-from typing import Callable, Optional, TypedDict
+from typing import Callable, Coroutine, Optional, TypedDict
 
 from aiohttp import ClientSession
 
 SIGNAL_CONNECTED = "connected"
 SIGNAL_CLOUD_ERROR = "cloud_error"
 SIGNAL_UPDATE = "update"
+SIGNAL_BREAKER = "local_breaker"
+SIGNAL_ALIVE = "local_alive"
 
 
 class XDevice(TypedDict, total=False):
@@ -33,23 +38,30 @@ class XDevice(TypedDict, total=False):
     localfail: Optional[int]
     localrecv: Optional[float]
     localping: Optional[float]
+    localinterval: Optional[float]  # seconds between pings, see local_alive
+    local_due: Optional[float]  # next run_forever check for this device
 
     cloud_seq: int | None  # sequence for update from cloud (if exists - cmd from app)
     last_cloud_command: Optional[dict]
     last_cloud_error: Optional[dict]
     last_cloud_success: Optional[float]
     local_seq: int | None  # sequence for update from local
+    recent_updates: Optional[deque]  # helper for is_duplicate_update
+    state_ts: Optional[float]  # monotonic time of the last switch state
+    command_ts: Optional[float]  # monotonic time of the last command to device
 
     parent: Optional[dict]
 
 
 class XRegistryBase:
     dispatcher: dict[str, list[Callable]] = None
+    dispatcher_keys: dict[str, dict[str | None, list[Callable]]] = None
     _sequence: int = 0
     _sequence_lock: asyncio.Lock = asyncio.Lock()
 
     def __init__(self, session: ClientSession):
         self.dispatcher = {}
+        self.dispatcher_keys = {}
         self.session = session
 
     @staticmethod
@@ -63,11 +75,28 @@ class XRegistryBase:
                 XRegistryBase._sequence += 1
             return str(XRegistryBase._sequence)
 
-    def dispatcher_connect(self, signal: str, target: Callable) -> Callable:
+    def dispatcher_connect(
+        self, signal: str, target: Callable, keys: set = None
+    ) -> Callable:
+        """Connect target to signal.
+
+        Targets with `keys` are skipped by `dispatcher_send_keys` when a message
+        has none of these keys. An empty set means only `dispatcher_send` calls.
+        """
         targets = self.dispatcher.setdefault(signal, [])
+        index = self.dispatcher_keys.setdefault(signal, {})
+        keys = [None] if keys is None else list(keys)
         if target not in targets:
             targets.append(target)
-        return lambda: targets.remove(target)
+            for key in keys:
+                index.setdefault(key, []).append(target)
+
+        def disconnect():
+            targets.remove(target)
+            for k in keys:
+                index[k].remove(target)
+
+        return disconnect
 
     def dispatcher_send(self, signal: str, *args, **kwargs):
         if not self.dispatcher.get(signal):
@@ -75,8 +104,96 @@ class XRegistryBase:
         for handler in self.dispatcher[signal]:
             handler(*args, **kwargs)
 
+    def dispatcher_send_keys(self, signal: str, params: dict):
+        """Send params only to targets interested in any of params keys."""
+        if not (index := self.dispatcher_keys.get(signal)):
+            return
+        # dict keeps call order and skips targets with many matched keys
+        handlers = dict.fromkeys(index.get(None, ()))
+        for key in params:
+            if key in index:
+                handlers.update(dict.fromkeys(index[key]))
+        for handler in handlers:
+            handler(params)
+
     async def dispatcher_wait(self, signal: str):
         event = asyncio.Event()
         disconnect = self.dispatcher_connect(signal, lambda: event.set())
         await event.wait()
         disconnect()
+
+
+class XTaskPool:
+    """Run background coroutines with limited concurrency.
+
+    Waiting coroutines get a free slot by priority (lower is first), then by
+    arrival. Priority 0 is never queued, so user commands don't wait for polls.
+    """
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.in_flight = 0
+        self.tasks: set[asyncio.Task] = set()
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+
+    @property
+    def limit(self) -> int:
+        return self._limit
+
+    @limit.setter
+    def limit(self, value: int):
+        # without free slots only priority 0 would ever run
+        self._limit = max(value, 1)
+
+    @property
+    def queued(self) -> int:
+        return sum(not fut.done() for _, _, fut in self._waiters)
+
+    async def acquire(self, priority: int):
+        if priority == 0 or (self.in_flight < self.limit and not self.queued):
+            self.in_flight += 1
+            return
+
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._counter), fut))
+        try:
+            # slot is counted by release before the future is done
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                self.release()
+            raise
+
+    def release(self):
+        self.in_flight -= 1
+        while self.in_flight < self.limit and self._waiters:
+            _, _, fut = heapq.heappop(self._waiters)
+            if not fut.done():
+                self.in_flight += 1
+                fut.set_result(None)
+
+    async def run(self, coro: Coroutine, priority: int):
+        try:
+            await self.acquire(priority)
+        except asyncio.CancelledError:
+            coro.close()
+            raise
+        try:
+            return await coro
+        finally:
+            self.release()
+
+    def create_task(self, coro: Coroutine, priority: int) -> asyncio.Task:
+        task = asyncio.get_event_loop().create_task(self.run(coro, priority))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return task
+
+    def cancel(self):
+        for task in self.tasks:
+            task.cancel()
+        self.tasks.clear()
+
+    def stats(self) -> dict:
+        return {"limit": self.limit, "in_flight": self.in_flight, "queued": self.queued}
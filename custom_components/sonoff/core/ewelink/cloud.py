@@ -9,6 +9,7 @@ import hmac
 import json
 import logging
 import time
+from collections import deque
 
 from aiohttp import (
     ClientConnectorError,
@@ -254,6 +255,19 @@ DATA_ERROR = {0: "online", 503: "offline", 504: "timeout", None: "unknown"}
 
 APP = ["R8Oq3y0eSZSYdKccHlrQzT1ACCOUT9Gv"]
 
+# protect cloud from DDoS (it can break connection)
+CLOUD_RATE = 10  # requests per second
+CLOUD_BURST = 3
+
+# Cloud request priorities, lower is first
+CLOUD_PRIORITY_USER = 0
+CLOUD_PRIORITY_RECONCILE = 1
+CLOUD_PRIORITY_QUERY = 2
+CLOUD_PRIORITY_POLL = 3
+
+# max parallel device list requests, one per home
+HOMES_CONCURRENCY = 4
+
 
 class AuthError(Exception):
     pass
@@ -274,36 +288,146 @@ def cloud_error_event(data: dict) -> dict:
 
 
 class ResponseWaiter:
-    """Class wait right sequences in response messages."""
+    """Class wait right sequences in response messages.
+
+    Each registry has own waiters. Timeouts are loop timers, so a command costs
+    one future and one timer handle.
+    """
 
-    _waiters: dict[str, asyncio.Future] = {}
+    def __init__(self, *args):
+        super().__init__(*args)
+        self._waiters: dict[str, tuple[asyncio.Future, asyncio.TimerHandle]] = {}
 
     def _set_response(self, sequence: str, error: int) -> bool:
         if sequence not in self._waiters:
             return False
 
-        try:
-            # sometimes the error doesn't exists
-            result = DATA_ERROR[error] if error in DATA_ERROR else f"E#{error}"
-            self._waiters[sequence].set_result(result)
-            return True
-        except Exception:
+        # sometimes the error doesn't exists
+        result = DATA_ERROR[error] if error in DATA_ERROR else f"E#{error}"
+        return self._resolve_response(sequence, result)
+
+    def _resolve_response(self, sequence: str, result: str) -> bool:
+        fut, handle = self._waiters.pop(sequence)
+        handle.cancel()
+        if fut.done():
             return False
+        fut.set_result(result)
+        return True
+
+    def _fail_responses(self, result: str = "timeout"):
+        """Resolve all waiters at once, for example when connection drops.
+        Device may have got the command, so the result is the same as timeout.
+        """
+        for sequence in list(self._waiters):
+            self._resolve_response(sequence, result)
 
     async def _wait_response(self, sequence: str, timeout: float):
-        self._waiters[sequence] = fut = asyncio.get_event_loop().create_future()
+        loop = asyncio.get_event_loop()
+        fut = loop.create_future()
+        handle = loop.call_at(
+            loop.time() + timeout, self._resolve_response, sequence, "timeout"
+        )
+        self._waiters[sequence] = (fut, handle)
 
         try:
-            # limit future wait time
-            await asyncio.wait_for(fut, timeout)
-        except asyncio.TimeoutError:
-            return "timeout"
+            return await fut
         finally:
-            # remove future from waiters
-            _ = self._waiters.pop(sequence, None)
+            # remove future from waiters if the caller was cancelled
+            if sequence in self._waiters and self._waiters[sequence][0] is fut:
+                self._waiters.pop(sequence)[1].cancel()
+
+
+class XCloudLimiter:
+    """Token bucket for Cloud requests of one account with priority lanes.
+
+    Waiting requests of one lane take turns by device, so one device with many
+    requests (e.g. energy history) doesn't delay the others.
+    """
+
+    def __init__(self, rate: float = CLOUD_RATE, burst: int = CLOUD_BURST):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.ts = time.monotonic()
+        # priority => deviceid => waiters, dict order is the device turn
+        self.lanes: dict[int, dict[str, deque[asyncio.Future]]] = {}
+        self.handle: asyncio.TimerHandle | None = None
 
-        # remove future from waiters and return result
-        return fut.result()
+    @property
+    def queued(self) -> int:
+        return sum(len(i) for lane in self.lanes.values() for i in lane.values())
+
+    def refill(self):
+        ts = time.monotonic()
+        self.tokens = min(self.tokens + (ts - self.ts) * self.rate, self.burst)
+        self.ts = ts
+
+    async def acquire(self, deviceid: str, priority: int) -> bool:
+        """Wait for a token, return True if the request had to wait."""
+        self.refill()
+        if self.tokens >= 1 and not self.lanes:
+            self.tokens -= 1
+            return False
+
+        fut = asyncio.get_event_loop().create_future()
+        lane = self.lanes.setdefault(priority, {})
+        lane.setdefault(deviceid, deque()).append(fut)
+        self.schedule()
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # cancelled future will be skipped by release
+            fut.cancel()
+            raise
+        return True
+
+    def schedule(self):
+        if self.handle is None:
+            delay = max((1 - self.tokens) / self.rate, 0)
+            self.handle = asyncio.get_event_loop().call_later(delay, self.release)
+
+    def release(self):
+        self.handle = None
+        self.refill()
+        while self.tokens >= 1 and (fut := self.next_waiter()):
+            self.tokens -= 1
+            fut.set_result(None)
+        if self.lanes:
+            self.schedule()
+
+    def next_waiter(self) -> asyncio.Future | None:
+        for priority in sorted(self.lanes):
+            lane = self.lanes[priority]
+            while lane:
+                deviceid, waiters = next(iter(lane.items()))
+                fut = waiters.popleft()
+                # move the device to the end of the lane
+                del lane[deviceid]
+                if waiters:
+                    lane[deviceid] = waiters
+                if not fut.done():
+                    if not lane:
+                        del self.lanes[priority]
+                    return fut
+            del self.lanes[priority]
+        return None
+
+    def cancel(self):
+        if self.handle:
+            self.handle.cancel()
+            self.handle = None
+        for lane in self.lanes.values():
+            for waiters in lane.values():
+                for fut in waiters:
+                    fut.cancel()
+        self.lanes.clear()
+
+    def stats(self) -> dict:
+        return {
+            "rate": self.rate,
+            "tokens": round(self.tokens, 2),
+            "queued": {k: sum(map(len, v.values())) for k, v in self.lanes.items()},
+        }
 
 
 def sign(msg: bytes) -> bytes:
@@ -320,7 +444,7 @@ def sign(msg: bytes) -> bytes:
 class XRegistryCloud(ResponseWaiter, XRegistryBase):
     auth: dict | None = None
     devices: dict[str, dict] = None
-    last_ts: float = 0
+    homes: list | None = None
     last_ui_active: float = 0
     online: bool | None = None
     region: str = None
@@ -328,6 +452,13 @@ class XRegistryCloud(ResponseWaiter, XRegistryBase):
     task: asyncio.Task | None = None
     ws: ClientWebSocketResponse = None
 
+    def __init__(self, session):
+        super().__init__(session)
+        self.limiter = XCloudLimiter()
+        # frames counters, lag - max time of frame processing in the last second
+        self.ws_stats = {"frames": 0, "frames_per_sec": 0.0, "lag_ms": 0.0}
+        self.ws_window = (time.monotonic(), 0, 0.0)  # start, frames, max lag
+
     @property
     def host(self) -> str:
         return API[self.region]
@@ -418,25 +549,30 @@ class XRegistryCloud(ResponseWaiter, XRegistryBase):
         return {i["id"]: i["name"] for i in resp["data"]["familyList"]}
 
     async def get_devices(self, homes: list = None) -> list[dict]:
-        devices = []
-        for home in homes or [None]:
-            r = await self.session.get(
-                self.host + "/v2/device/thing",
-                headers=self.headers,
-                timeout=10,
-                params={"num": 0, "familyid": home} if home else {"num": 0},
-            )
-            resp = await r.json()
+        """Load devices of selected homes in parallel, keeping homes order."""
+        semaphore = asyncio.Semaphore(HOMES_CONCURRENCY)
+
+        async def get_home(home: str | None) -> list[dict]:
+            async with semaphore:
+                r = await self.session.get(
+                    self.host + "/v2/device/thing",
+                    headers=self.headers,
+                    timeout=10,
+                    params={"num": 0, "familyid": home} if home else {"num": 0},
+                )
+                resp = await r.json()
             if resp["error"] != 0:
                 raise Exception(resp["msg"])
             # item type: 1 - user device, 2 - shared device, 3 - user group,
             # 5 - share device (home)
-            devices += [
+            return [
                 i["itemData"]
                 for i in resp["data"]["thingList"]
                 if "deviceid" in i["itemData"]  # skip groups
             ]
-        return devices
+
+        results = await asyncio.gather(*[get_home(home) for home in homes or [None]])
+        return [device for devices in results for device in devices]
 
     async def set_device(self, device: XDevice, params: dict, timeout: float = 5):
         did = device["deviceid"]
@@ -458,6 +594,7 @@ class XRegistryCloud(ResponseWaiter, XRegistryBase):
         params: dict = None,
         sequence: str = None,
         timeout: float = 5,
+        priority: int = CLOUD_PRIORITY_USER,
     ):
         """With params - send new state to device, without - request device
         state. With zero timeout - won't wait response.
@@ -474,10 +611,8 @@ class XRegistryCloud(ResponseWaiter, XRegistryBase):
             self.last_ui_active = time.time()
 
         # protect cloud from DDoS (it can break connection)
-        while (delay := self.last_ts + 0.1 - time.time()) > 0:
+        if await self.limiter.acquire(device["deviceid"], priority):
             log += "DDoS | "
-            await asyncio.sleep(delay)
-        self.last_ts = time.time()
 
         if sequence is None:
             sequence = await self.sequence()
@@ -518,6 +653,9 @@ class XRegistryCloud(ResponseWaiter, XRegistryBase):
             self.task.cancel()
             self.task = None
 
+        self.limiter.cancel()
+        self._fail_responses()
+
         self.set_online(None)
 
     def set_online(self, value: bool = None):
@@ -560,13 +698,21 @@ class XRegistryCloud(ResponseWaiter, XRegistryBase):
                         continue
                     if isinstance(msg.data, ServerTimeoutError):
                         raise msg.data
-                    resp = json.loads(msg.data)
-                    _ = asyncio.create_task(self._process_ws_msg(resp))
+                    # process frames in order they came, a handler doesn't wait
+                    ts = time.monotonic()
+                    try:
+                        self._process_ws_msg(json.loads(msg.data))
+                    except Exception as e:
+                        _LOGGER.warning("Cloud message error", exc_info=e)
+                    self._update_ws_stats(ts)
             except ServerTimeoutError:
                 pass
             except Exception as e:
                 _LOGGER.warning("Cloud processing error", exc_info=e)
 
+            # don't wait timeouts of commands sent to the closed connection
+            self._fail_responses()
+
     async def connect(self) -> bool:
         try:
             # https://coolkit-technologies.github.io/eWeLink-API/#/en/APICenterV2?id=http-dispatchservice-app
@@ -621,7 +767,20 @@ class XRegistryCloud(ResponseWaiter, XRegistryBase):
 
         return False
 
-    async def _process_ws_msg(self, data: dict):
+    def _update_ws_stats(self, ts: float):
+        now = time.monotonic()
+        start, frames, lag = self.ws_window
+        frames += 1
+        lag = max(lag, now - ts)
+        self.ws_stats["frames"] += 1
+        if (window := now - start) >= 1:
+            self.ws_stats["frames_per_sec"] = round(frames / window, 1)
+            self.ws_stats["lag_ms"] = round(lag * 1000, 1)
+            self.ws_window = (now, 0, 0.0)
+        else:
+            self.ws_window = (start, frames, lag)
+
+    def _process_ws_msg(self, data: dict):
         if "action" not in data:
             # response on our command
             if "sequence" in data:
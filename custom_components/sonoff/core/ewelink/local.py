@@ -6,36 +6,101 @@ devices and their devicekey.
 
 import asyncio
 import base64
+import binascii
 import errno
 import hashlib
+import heapq
 import ipaddress
+import itertools
 import json
 import logging
 import os
+import time
+from collections import deque
+from functools import lru_cache
 
 import aiohttp
+from aiohttp import ClientSession
 from aiohttp.hdrs import CONTENT_TYPE
-from cryptography.hazmat.primitives import padding
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
 from zeroconf import ServiceStateChange, Zeroconf
 from zeroconf.asyncio import AsyncServiceBrowser, AsyncServiceInfo
 
-from .base import SIGNAL_CONNECTED, SIGNAL_UPDATE, XDevice, XRegistryBase
+from .base import (
+    SIGNAL_ALIVE,
+    SIGNAL_BREAKER,
+    SIGNAL_CONNECTED,
+    SIGNAL_UPDATE,
+    XDevice,
+    XRegistryBase,
+)
 
 _LOGGER = logging.getLogger(__name__)
 
+LOCAL_MIN_TIMEOUT = 0.1
+# LAN request priorities, lower is first
+PRIORITY_COMMAND = 0
+PRIORITY_QUERY = 1
+PRIORITY_REFRESH = 2
+PRIORITY_PING = 3
+# retransmission timeout limits for requests with Cloud fallback (RFC 6298)
+LOCAL_RTO_INIT = 1
+LOCAL_RTO_MIN = 0.1
+LOCAL_RTO_MAX = 5
+LOCAL_HEDGE_DELAY = 0.5  # before the first answer from the device
+
+# circuit breaker for requests with Cloud fallback
+BREAKER_CLOSED = "closed"
+BREAKER_OPEN = "open"
+BREAKER_HALF_OPEN = "half_open"
+BREAKER_FAILURES = 3  # in a row
+BREAKER_COOLDOWN = 5  # seconds, doubles after failed trial request
+BREAKER_COOLDOWN_MAX = 60
+HEALTH_SAMPLES = 20
+HEALTH_MIN = 0.5
+# health score of failed request, a reset is often a single stale connection
+HEALTH_SCORES = {"E#CRE": 0.5, "E#COS": 0.5}
+HEALTH_FAILURES = ("timeout", "E#CON", "E#CRE", "E#COE", "E#COS", "E#???")
+
+
+class XLocalCrypto:
+    """AES-128-CBC context of one devicekey.
+
+    The key is derived once per devicekey. Only the IV changes between
+    messages, so a new cipher object is cheap.
+    """
+
+    def __init__(self, devicekey: str):
+        key = hashlib.md5(devicekey.encode("utf-8")).digest()
+        self.algorithm = algorithms.AES(key)
+
+    def encrypt(self, plaintext: bytes, iv: bytes) -> bytes:
+        pad = 16 - len(plaintext) % 16
+        encryptor = Cipher(self.algorithm, modes.CBC(iv)).encryptor()
+        return encryptor.update(plaintext + bytes((pad,)) * pad) + encryptor.finalize()
+
+    def decrypt(self, data: str, iv: str) -> bytes:
+        ciphertext = binascii.a2b_base64(data)
+        iv = binascii.a2b_base64(iv)
+        decryptor = Cipher(self.algorithm, modes.CBC(iv)).decryptor()
+        padded_data = decryptor.update(ciphertext) + decryptor.finalize()
+
+        # PKCS7, wrong devicekey will fail here in most cases
+        pad = padded_data[-1] if padded_data else 0
+        if not 0 < pad <= 16 or padded_data[-pad:] != bytes((pad,)) * pad:
+            raise ValueError("Invalid padding bytes.")
+        return padded_data[:-pad]
+
+
+@lru_cache(maxsize=1024)
+def get_crypto(devicekey: str) -> XLocalCrypto:
+    return XLocalCrypto(devicekey)
+
 
 def encrypt(payload: dict, devicekey: str):
     plaintext = json.dumps(payload["data"]).encode("utf-8")
-    key = hashlib.md5(devicekey.encode("utf-8")).digest()
     iv = os.urandom(16)
-
-    padder = padding.PKCS7(128).padder()
-    padded_data = padder.update(plaintext) + padder.finalize()
-
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
-    encryptor = cipher.encryptor()
-    ciphertext = encryptor.update(padded_data) + encryptor.finalize()
+    ciphertext = get_crypto(devicekey).encrypt(plaintext, iv)
 
     payload["encrypt"] = True
     payload["data"] = base64.b64encode(ciphertext).decode("utf-8")
@@ -45,22 +110,152 @@ def encrypt(payload: dict, devicekey: str):
 
 
 def decrypt(payload: dict, devicekey: str):
-    ciphertext = base64.b64decode(payload["data"])
-    key = hashlib.md5(devicekey.encode("utf-8")).digest()
-    iv = base64.b64decode(payload["iv"])
-
-    cipher = Cipher(algorithms.AES(key), modes.CBC(iv))
-    decryptor = cipher.decryptor()
-    padded_data = decryptor.update(ciphertext) + decryptor.finalize()
-
-    unpadder = padding.PKCS7(128).unpadder()
-    return unpadder.update(padded_data) + unpadder.finalize()
+    return get_crypto(devicekey).decrypt(payload["data"], payload["iv"])
+
+
+class XLocalTransport:
+    """Serialise requests to the single-threaded web server of one device.
+
+    Waiting requests get the device by priority (lower is first), then by
+    arrival. So a user command doesn't wait behind sensor refreshes and pings.
+
+    Connections are kept alive until the firmware closes one without a notice,
+    after that each request uses its own connection again.
+
+    Round-trip time of the device is estimated like TCP does (RFC 6298). ESP8266
+    devices can answer 10 times slower than ESP32 ones.
+
+    Circuit breaker opens after a few failed requests in a row or bad health, so
+    commands go to the Cloud without waiting for LAN timeout. After cooldown one
+    trial request goes to LAN (half open state).
+    """
+
+    def __init__(self):
+        self.busy = False
+        self.waiters: list[tuple[int, int, asyncio.Future]] = []
+        self.counter = itertools.count()
+        self.keepalive = True
+        self.srtt: float | None = None  # smoothed round-trip time
+        self.rttvar: float | None = None  # round-trip time variation
+        self.rto: float = LOCAL_RTO_INIT
+        self.breaker = BREAKER_CLOSED
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.retry_at = 0.0
+        self.outcomes: deque[float] = deque(maxlen=HEALTH_SAMPLES)
+
+    async def acquire(self, priority: int) -> bool:
+        """Wait for the turn. Return False if the request was dropped."""
+        if not self.busy:
+            self.busy = True
+            return True
+
+        fut = asyncio.get_event_loop().create_future()
+        heapq.heappush(self.waiters, (priority, next(self.counter), fut))
+        try:
+            return await fut
+        except asyncio.CancelledError:
+            # got the turn at the same moment with timeout
+            if fut.done() and not fut.cancelled() and fut.result():
+                self.release()
+            raise
+
+    def release(self):
+        while self.waiters:
+            _, _, fut = heapq.heappop(self.waiters)
+            if not fut.done():
+                fut.set_result(True)
+                return
+        self.busy = False
+
+    def drop(self, priority: int) -> int:
+        """Drop waiting requests with priority, return their number."""
+        dropped = 0
+        for waiter in self.waiters:
+            if waiter[0] == priority and not waiter[2].done():
+                waiter[2].set_result(False)
+                dropped += 1
+        if dropped:
+            self.waiters = [i for i in self.waiters if not i[2].done()]
+            heapq.heapify(self.waiters)
+        return dropped
+
+    @property
+    def health(self) -> float:
+        if not self.outcomes:
+            return 1.0
+        return sum(self.outcomes) / len(self.outcomes)
+
+    def allow(self) -> bool:
+        if self.breaker == BREAKER_CLOSED:
+            return True
+        ts = time.monotonic()
+        if ts < self.retry_at:
+            return False
+        # one trial request per cooldown
+        self.breaker = BREAKER_HALF_OPEN
+        self.retry_at = ts + self.cooldown
+        return True
+
+    def outcome(self, ok: str) -> bool:
+        """Record request result and return True if the breaker has changed."""
+        breaker = self.breaker
+        if ok not in HEALTH_FAILURES:
+            self.outcomes.append(1.0)
+            self.failures = 0
+            self.cooldown = BREAKER_COOLDOWN
+            self.breaker = BREAKER_CLOSED
+            return breaker != BREAKER_CLOSED
+
+        self.outcomes.append(HEALTH_SCORES.get(ok, 0.0))
+        self.failures += 1
+        if breaker == BREAKER_HALF_OPEN:
+            self.cooldown = min(self.cooldown * 2, BREAKER_COOLDOWN_MAX)
+        elif breaker == BREAKER_CLOSED and (
+            self.failures < BREAKER_FAILURES
+            and (len(self.outcomes) < 5 or self.health >= HEALTH_MIN)
+        ):
+            return False
+        self.breaker = BREAKER_OPEN
+        self.retry_at = time.monotonic() + self.cooldown
+        return breaker != BREAKER_OPEN
+
+    def rtt_sample(self, rtt: float):
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(max(self.srtt + 4 * self.rttvar, LOCAL_RTO_MIN), LOCAL_RTO_MAX)
+
+    def rtt_timeout(self):
+        # back off until the next answer from the device
+        self.rto = min(self.rto * 2, LOCAL_RTO_MAX)
+
+    def stats(self) -> dict:
+        return {
+            "srtt": round(self.srtt, 3) if self.srtt is not None else None,
+            "rttvar": round(self.rttvar, 3) if self.rttvar is not None else None,
+            "rto": round(self.rto, 3),
+            "keepalive": self.keepalive,
+            "breaker": self.breaker,
+            "health": round(self.health, 2),
+        }
 
 
 class XRegistryLocal(XRegistryBase):
     browser: AsyncServiceBrowser = None
     online: bool = False
 
+    def __init__(self, session: ClientSession):
+        super().__init__(session)
+        self.transports: dict[str, XLocalTransport] = {}
+        # service name => repeat the request after the current one
+        self.info_requests: dict[str, bool] = {}
+        # (deviceid, subdevid) => (seq, raw hash, host) of the last TXT record
+        self.last_txt: dict[tuple, tuple] = {}
+
     def start(self, zeroconf: Zeroconf):
         self.browser = AsyncServiceBrowser(
             zeroconf, "_ewelink._tcp.local.", [self._handler1]
@@ -73,6 +268,9 @@ class XRegistryLocal(XRegistryBase):
             return
         self.online = False
         await self.browser.async_cancel()
+        self.transports.clear()
+        self.info_requests.clear()
+        self.last_txt.clear()
 
     def _handler1(
         self,
@@ -89,17 +287,46 @@ class XRegistryLocal(XRegistryBase):
         if not name.lower().startswith("ewelink"):
             return
 
+        # one request per service name, events during the request are merged
+        # into one more request after it
+        if name in self.info_requests:
+            self.info_requests[name] = True
+            return
+
+        # fast path: records from the event are already in the zeroconf cache
+        try:
+            info = AsyncServiceInfo(service_type, name)
+            if info.load_from_cache(zeroconf) and info.properties:
+                self._handler2_info(name[8:18], info)
+                return
+        except Exception as e:
+            _LOGGER.debug(f"{name[8:18]} <= Local0 | Zeroconf error", exc_info=e)
+            return
+
+        self.info_requests[name] = False
         asyncio.create_task(self._handler2(zeroconf, service_type, name))
 
     async def _handler2(self, zeroconf: Zeroconf, service_type: str, name: str):
         """Step 2. Request additional info about add and update event from device."""
         deviceid = name[8:18]
         try:
-            info = AsyncServiceInfo(service_type, name)
-            if not await info.async_request(zeroconf, 3000) or not info.properties:
-                _LOGGER.debug(f"{deviceid} <= Local0 | Can't get zeroconf info")
-                return
+            while True:
+                info = AsyncServiceInfo(service_type, name)
+                if await info.async_request(zeroconf, 3000) and info.properties:
+                    self._handler2_info(deviceid, info)
+                else:
+                    _LOGGER.debug(f"{deviceid} <= Local0 | Can't get zeroconf info")
+
+                if not self.info_requests.get(name):
+                    break
+                self.info_requests[name] = False
+        except Exception as e:
+            _LOGGER.debug(f"{deviceid} <= Local0 | Zeroconf error", exc_info=e)
+        finally:
+            self.info_requests.pop(name, None)
 
+    def _handler2_info(self, deviceid: str, info: AsyncServiceInfo):
+        try:
             # support update with empty host and host without port
             for addr in info.addresses:
                 # zeroconf lib should return IPv4, but better check anyway
@@ -127,6 +354,19 @@ class XRegistryLocal(XRegistryBase):
 
         raw = "".join([data[f"data{i}"] for i in range(1, 5, 1) if f"data{i}" in data])
 
+        # any message is fresher than a waiting ping
+        if transport := self.transports.get(deviceid):
+            transport.drop(PRIORITY_PING)
+
+        # skip repeats of unchanged TXT record
+        key = (deviceid, data["id"])
+        txt = (data.get("seq"), hash(raw), host)
+        if self.last_txt.get(key) == txt:
+            # but it still proves that the device is online
+            self.dispatcher_send(SIGNAL_ALIVE, deviceid, True)
+            return
+        self.last_txt[key] = txt
+
         msg = {
             "deviceid": deviceid,
             "subdevid": data["id"],
@@ -152,7 +392,7 @@ class XRegistryLocal(XRegistryBase):
         command: str = None,
         sequence: str = None,
         timeout: int = 5,
-        cre_retry_counter: int = 10,
+        priority: int = PRIORITY_COMMAND,
     ):
         # known commands for DIY: switch, startup, pulse, sledonline
         # other commands: switch, switches, transmit, dimmable, light, fan
@@ -179,12 +419,89 @@ class XRegistryLocal(XRegistryBase):
 
         log = f"{device['deviceid']} => Local4 | {host} | {command} {params or {}}"
 
+        # The device's web server is not multi-threaded and can only process one
+        # request at a time. Concurrent requests are reset by the device, so all
+        # requests to one device wait in a priority queue. The wait counts
+        # towards the request timeout.
+        transport = self.transports.setdefault(device["deviceid"], XLocalTransport())
+        ts = time.monotonic()
+        try:
+            if not await asyncio.wait_for(transport.acquire(priority), timeout):
+                # the device answered while the ping was waiting
+                _LOGGER.debug(f"{log} !! Dropped")
+                return "online"
+        except asyncio.TimeoutError:
+            _LOGGER.debug(f"{log} !! Queue timeout {timeout}")
+            return "timeout"
+
+        # noinspection HttpUrlsUsage
+        url = f"http://{host}/zeroconf/{command}"
+        args = (device, transport, url, command, params, payload)
+        try:
+            ts2 = time.monotonic()
+            timeout = max(timeout - (ts2 - ts), LOCAL_MIN_TIMEOUT)
+            ok = await self._post(*args, timeout, log)
+            if ok == "E#CRE" and transport.keepalive:
+                # Firmware closed an idle keep-alive connection before reading
+                # the request. Fall back to one connection per request and try
+                # once more, the request wasn't processed by the device.
+                _LOGGER.debug(f"{log} !! Disable keep-alive")
+                transport.keepalive = False
+                ok = await self._post(*args, timeout, log)
+            elif ok in ("online", "error"):
+                # samples only from requests without retry (Karn's algorithm)
+                transport.rtt_sample(time.monotonic() - ts2)
+            if ok == "timeout":
+                transport.rtt_timeout()
+            if transport.outcome(ok):
+                _LOGGER.debug(f"{log} !! Breaker {transport.breaker}")
+                self.dispatcher_send(SIGNAL_BREAKER, device["deviceid"])
+            if ok == "online":
+                transport.drop(PRIORITY_PING)
+                self.dispatcher_send(SIGNAL_ALIVE, device["deviceid"], False)
+            return ok
+        finally:
+            transport.release()
+
+    def timeout(self, device: XDevice) -> float:
+        """Return timeout for a request with Cloud fallback."""
+        transport = self.transports.get(device["deviceid"])
+        return transport.rto if transport else LOCAL_RTO_INIT
+
+    def allow(self, device: XDevice) -> bool:
+        """Check if a request with Cloud fallback should try LAN."""
+        transport = self.transports.get(device["deviceid"])
+        return transport is None or transport.allow()
+
+    def hedge_delay(self, device: XDevice) -> float:
+        """Return time after which the answer from the device is late."""
+        transport = self.transports.get(device["deviceid"])
+        if not transport or transport.srtt is None:
+            return LOCAL_HEDGE_DELAY
+        delay = transport.srtt + 2 * transport.rttvar
+        return min(max(delay, LOCAL_RTO_MIN), transport.rto)
+
+    def transport_stats(self, deviceid: str) -> dict | None:
+        if transport := self.transports.get(deviceid):
+            return transport.stats()
+        return None
+
+    async def _post(
+        self,
+        device: XDevice,
+        transport: XLocalTransport,
+        url: str,
+        command: str,
+        params: dict | None,
+        payload: dict,
+        timeout: float,
+        log: str,
+    ) -> str:
         try:
-            # noinspection HttpUrlsUsage
             r = await self.session.post(
-                f"http://{host}/zeroconf/{command}",
+                url,
                 json=payload,
-                headers={"Connection": "close"},
+                headers=None if transport.keepalive else {"Connection": "close"},
                 timeout=timeout,
             )
 
@@ -237,26 +554,20 @@ class XRegistryLocal(XRegistryBase):
                 _LOGGER.debug(log, exc_info=e)
                 return "E#COE"  # ClientOSError
 
-            # This happens because the device's web server is not multi-threaded
-            # and can only process one request at a time. Therefore, if the
-            # device is busy processing another request, it will close the
-            # connection for the new request and we will get this error.
-            #
-            # It appears that the device takes some time to process a new request
-            # after the previous one was closed, which caused a locking approach
-            # to not work across different devices. Simply retrying on this error
-            # a few times seems to fortunately work reliably, so we'll do that.
-
+            # Requests from this registry are already serialised per device, so
+            # a reset means a stale keep-alive connection or another client
+            # (e.g. the eWeLink app) talking to the device at the same time.
             _LOGGER.debug(f"{log} !! ConnectionResetError")
-            if cre_retry_counter > 0:
-                await asyncio.sleep(0.1)
-                return await self.send(
-                    device, params, command, sequence, timeout, cre_retry_counter - 1
-                )
-
             return "E#CRE"  # ConnectionResetError
 
-        except (aiohttp.ServerDisconnectedError, asyncio.CancelledError) as e:
+        except aiohttp.ServerDisconnectedError as e:
+            if transport.keepalive:
+                _LOGGER.debug(f"{log} !! ServerDisconnectedError")
+                return "E#CRE"
+            _LOGGER.debug(log, exc_info=e)
+            return "E#COS"
+
+        except asyncio.CancelledError as e:
             _LOGGER.debug(log, exc_info=e)
             return "E#COS"
 
@@ -271,8 +582,28 @@ class XRegistryLocal(XRegistryBase):
         if not msg.get("data"):
             return {}
 
-        data = decrypt(msg, devicekey)
+        return XRegistryLocal.load_msg(decrypt(msg, devicekey))
 
+    @staticmethod
+    def decrypt_msgs(msgs: list[dict], devicekey: str) -> list[dict | Exception]:
+        """Decrypt queued messages of one device. A broken message doesn't stop
+        the batch, its error is returned in place of params.
+        """
+        crypto = get_crypto(devicekey)
+        result = []
+        for msg in msgs:
+            try:
+                if msg.get("data"):
+                    data = crypto.decrypt(msg["data"], msg["iv"])
+                    result.append(XRegistryLocal.load_msg(data))
+                else:
+                    result.append({})
+            except Exception as e:
+                result.append(e)
+        return result
+
+    @staticmethod
+    def load_msg(data: bytes) -> dict:
         # Fix Sonoff RF Bridge sintax bug
         if data and data.startswith(b'{"rf'):
             data = data.replace(b'"="', b'":"')
@@ -83,7 +83,12 @@ def diagnostic_secret_values(registry: XRegistry) -> tuple[str, ...]:
     return tuple(sorted(values, key=len, reverse=True))
 
 
-def device_diagnostics(device: dict, secret_values: tuple[str, ...]) -> dict:
+def device_diagnostics(
+    device: dict,
+    secret_values: tuple[str, ...],
+    local_transport: dict = None,
+    children: int = 0,
+) -> dict:
     """Return only useful, non-identifying device diagnostics."""
     if "params" not in device:
         return {"localtype": device.get("localtype")}
@@ -95,6 +100,8 @@ def device_diagnostics(device: dict, secret_values: tuple[str, ...]) -> dict:
         "online": device.get("online"),
         "local": device.get("local"),
         "localtype": device.get("localtype"),
+        "local_transport": local_transport,
+        "children": children,
         "last_cloud_command": device.get("last_cloud_command"),
         "last_cloud_error": device.get("last_cloud_error"),
     }
@@ -120,8 +127,13 @@ async def async_get_config_entry_diagnostics(hass: HomeAssistant, entry: ConfigE
 
     try:
         devices = [
-            device_diagnostics(device, secret_values)
-            for device in registry.devices.values()
+            device_diagnostics(
+                device,
+                secret_values,
+                registry.local.transport_stats(did),
+                len(registry.children.get(did, ())),
+            )
+            for did, device in registry.devices.items()
         ]
     except Exception as err:
         devices = repr(err)
@@ -137,6 +149,11 @@ async def async_get_config_entry_diagnostics(hass: HomeAssistant, entry: ConfigE
         "cloud_command_errors": redact_diagnostics_data(
             list(registry.cloud_errors), secret_values
         ),
+        "local_pool": registry.local_pool.stats(),
+        "cloud_limiter": registry.cloud.limiter.stats(),
+        "cloud_ws": registry.cloud.ws_stats,
+        "startup": registry.startup,
+        "redundant_commands": registry.redundant_stats,
         "devices": devices,
     }
 
@@ -150,6 +167,8 @@ async def async_get_device_diagnostics(
     registry: XRegistry = hass.data[DOMAIN][entry.entry_id]
     info.pop("devices")
     info["device"] = device_diagnostics(
-        registry.devices.get(did, {}), diagnostic_secret_values(registry)
+        registry.devices.get(did, {}),
+        diagnostic_secret_values(registry),
+        registry.local.transport_stats(did),
     )
     return info
@@ -55,29 +55,22 @@ class XSelectStartup(XEntity, SelectEntity):
         await self.ewelink.send(self.device, self.get_params, timeout_lan=5)
 
     async def async_select_option(self, option: str):
-        # Start from the current device config so other channels are preserved
-        configure_list = [
-            dict(item)
+        if any(
+            isinstance(item, dict) and item.get("outlet") == self.channel
             for item in self.device.get("params", {}).get("configure", [])
-            if isinstance(item, dict)
-        ]
-
-        for item in configure_list:
-            if item.get("outlet") == self.channel:
-                item["startup"] = option
-                break
+        ):
+            item = {"outlet": self.channel, "startup": option}
         else:
-            configure_list.append(
-                {
-                    "outlet": self.channel,
-                    "startup": option,
-                    "enableDelay": 0, # this should be exposed as a config option in the future, for inching devices
-                    "width": 1000, # i don't know what this is for, but it seems to not have any effect on the device
-                }
-            )
-
-        # Send the full configure list so other channels are preserved
-        await self.ewelink.send(self.device, {"configure": configure_list})
+            item = {
+                "outlet": self.channel,
+                "startup": option,
+                "enableDelay": 0, # this should be exposed as a config option in the future, for inching devices
+                "width": 1000, # i don't know what this is for, but it seems to not have any effect on the device
+            }
+
+        # send_bulk starts from the current device config, so the full configure
+        # list is sent and other channels are preserved
+        await self.ewelink.send_bulk(self.device, {"configure": [item]})
 
 
 class XStartup(XEntity, SelectEntity):
@@ -246,7 +246,9 @@ class XCloudEnergy(XEntity, SensorEntity):
         return self.available and self.ewelink.cloud.online
 
     async def get_update(self) -> bool:
-        ok = await self.ewelink.send_cloud(self.device, self.get_params, query=False)
+        ok = await self.ewelink.send_cloud(
+            self.device, self.get_params, query=False, origin="poll"
+        )
         return ok == "online"
 
     async def async_update(self):
@@ -549,7 +551,18 @@ class XConnection(XEntity, SensorEntity):
         else:
             value = "local" if local else "none"
 
-        if self._attr_native_value != value:
+        # LAN requests go to the main device (SPM-Main, RF Bridge)
+        device = self.device.get("parent") or self.device
+        if stats := self.ewelink.local.transport_stats(device["deviceid"]):
+            attrs = {"local_breaker": stats["breaker"], "local_health": stats["health"]}
+        else:
+            attrs = None
+
+        if (
+            self._attr_native_value != value
+            or self._attr_extra_state_attributes != attrs
+        ):
             self._attr_native_value = value
+            self._attr_extra_state_attributes = attrs
             if self.hass:
                 self._async_write_ha_state()
@@ -0,0 +1,394 @@
+import asyncio
+import errno
+import time
+
+from aiohttp import ClientOSError
+from zeroconf import ServiceStateChange
+
+from custom_components.sonoff.core.ewelink import (
+    SIGNAL_ALIVE,
+    SIGNAL_BREAKER,
+    SIGNAL_UPDATE,
+    XRegistry,
+    XRegistryLocal,
+)
+from custom_components.sonoff.core.ewelink import local
+
+
+class FakeResponse:
+    headers = {}
+
+    async def json(self):
+        return {"error": 0}
+
+
+class FakeSession:
+    def __init__(self, delay: float = 0, errors: list = None):
+        self.delay = delay
+        self.errors = errors or []
+        self.active = 0
+        self.max_active = 0
+        self.requests = []
+
+    async def post(self, url: str, json: dict, headers: dict, timeout: float):
+        self.requests.append((url, headers))
+        self.active += 1
+        self.max_active = max(self.max_active, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+            if self.errors:
+                raise self.errors.pop(0)
+            return FakeResponse()
+        finally:
+            self.active -= 1
+
+
+def test_requests_to_one_device_are_serialised():
+    session = FakeSession(delay=0.01)
+    # noinspection PyTypeChecker
+    registry = XRegistryLocal(session)
+    device = {"deviceid": "1000123abc", "host": "192.168.1.10"}
+
+    async def run():
+        return await asyncio.gather(
+            *[registry.send(device, {"switch": "on"}) for _ in range(5)]
+        )
+
+    assert asyncio.run(run()) == ["online"] * 5
+    assert session.max_active == 1
+    # keep-alive by default
+    assert session.requests[0][1] is None
+
+
+def test_connection_reset_disables_keepalive_and_retries_once():
+    session = FakeSession(
+        errors=[
+            ClientOSError(errno.ECONNRESET, "reset"),
+            ClientOSError(errno.ECONNRESET, "reset"),
+        ]
+    )
+    # noinspection PyTypeChecker
+    registry = XRegistryLocal(session)
+    device = {"deviceid": "1000123abc", "host": "192.168.1.10"}
+
+    assert asyncio.run(registry.send(device, {"switch": "on"})) == "E#CRE"
+    assert len(session.requests) == 2
+    assert session.requests[1][1] == {"Connection": "close"}
+
+    # no retries without keep-alive
+    session.errors = [ClientOSError(errno.ECONNRESET, "reset")]
+    assert asyncio.run(registry.send(device, {"switch": "on"})) == "E#CRE"
+    assert len(session.requests) == 3
+
+    assert asyncio.run(registry.send(device, {"switch": "on"})) == "online"
+
+
+class FakeServiceInfo:
+    cache = False
+    requests = 0
+
+    def __init__(self, service_type: str, name: str):
+        self.addresses = [b"\xc0\xa8\x01\x0a"]
+        self.port = 8081
+        self.server = None
+        self.properties = {}
+
+    def load_from_cache(self, zeroconf) -> bool:
+        if FakeServiceInfo.cache:
+            self.properties = {b"id": b"1000123abc", b"type": b"plug", b"seq": b"1"}
+        return FakeServiceInfo.cache
+
+    async def async_request(self, zeroconf, timeout: float) -> bool:
+        FakeServiceInfo.requests += 1
+        await asyncio.sleep(0.01)
+        self.properties = {
+            b"id": b"1000123abc",
+            b"type": b"plug",
+            b"seq": str(FakeServiceInfo.requests).encode(),
+            b"data1": b"{}",
+        }
+        return True
+
+
+def test_zeroconf_requests(monkeypatch):
+    monkeypatch.setattr(local, "AsyncServiceInfo", FakeServiceInfo)
+    # other tests replace it with a stub
+    monkeypatch.setattr(asyncio, "create_task", asyncio.tasks.create_task)
+    msgs = []
+
+    # noinspection PyTypeChecker
+    registry = XRegistryLocal(None)
+    registry.dispatcher_connect(SIGNAL_UPDATE, msgs.append)
+    name = "eWeLink_1000123abc._ewelink._tcp.local."
+
+    async def run():
+        # three events during one request result in one more request
+        for _ in range(3):
+            registry._handler1(None, "", name, ServiceStateChange.Updated)
+        await asyncio.sleep(0.05)
+        assert FakeServiceInfo.requests == 2
+        assert [msg["seq"] for msg in msgs] == ["1", "2"]
+        assert msgs[0]["host"] == "192.168.1.10:8081"
+        assert registry.info_requests == {}
+
+        # records from the zeroconf cache are processed without a request
+        FakeServiceInfo.cache = True
+        registry._handler1(None, "", name, ServiceStateChange.Updated)
+        assert FakeServiceInfo.requests == 2
+        assert len(msgs) == 3
+
+    asyncio.run(run())
+
+
+def test_unchanged_txt_is_skipped():
+    msgs = []
+
+    # noinspection PyTypeChecker
+    registry = XRegistryLocal(None)
+    registry.dispatcher_connect(SIGNAL_UPDATE, msgs.append)
+
+    data = {"id": "1000123abc", "type": "plug", "seq": "5", "data1": "{}"}
+    registry._handler3("1000123abc", "192.168.1.10", data)
+    registry._handler3("1000123abc", "192.168.1.10", dict(data))
+    assert len(msgs) == 1
+
+    registry._handler3("1000123abc", "192.168.1.11", dict(data))
+    registry._handler3("1000123abc", "192.168.1.11", dict(data, seq="6"))
+    assert len(msgs) == 3
+
+
+def test_store_devices():
+    cloud = {"deviceid": "1000123abc", "extra": {"uiid": 1}, "params": {}}
+    device = {
+        **cloud,
+        "params": {"switch": "on"},
+        "host": "192.168.1.10",
+        "localtype": "plug",
+        "local": True,
+        "localping": 0,
+        "parent": cloud,
+    }
+    cache = XRegistry.store_devices([device])
+    assert cache == [
+        {
+            "deviceid": "1000123abc",
+            "extra": {"uiid": 1},
+            "params": {"switch": "on"},
+            "host": "192.168.1.10",
+            "localtype": "plug",
+        }
+    ]
+
+    XRegistry.restore_devices([cloud], cache)
+    assert cloud["host"] == "192.168.1.10"
+    assert cloud["params"]["host"] == "192.168.1.10"
+    assert cloud["localtype"] == "plug"
+
+    # host from the config, mDNS message with the same host
+    # noinspection PyTypeChecker
+    registry = XRegistry(None)
+    device = {**cloud, "params": {}}
+    registry.devices = {"1000123abc": device}
+    registry.local_update(
+        {
+            "deviceid": "1000123abc",
+            "host": "192.168.1.10",
+            "localtype": "plug",
+            "params": {"switch": "on"},
+        }
+    )
+    assert device["params"] == {"switch": "on", "host": "192.168.1.10"}
+
+
+def test_probe_local():
+    session = FakeSession()
+    # noinspection PyTypeChecker
+    registry = XRegistry(session)
+    registry.local.online = True
+    registry.devices = {
+        "1000123abc": {
+            "deviceid": "1000123abc",
+            "extra": {"uiid": 1},
+            "params": {},
+            "host": "192.168.1.10",
+        },
+        "1000123abd": {"deviceid": "1000123abd", "extra": {"uiid": 1}, "params": {}},
+    }
+
+    assert asyncio.run(registry.probe_local()) == 1
+    assert registry.can_local(registry.devices["1000123abc"])
+    assert not registry.can_local(registry.devices["1000123abd"])
+    assert len(session.requests) == 1
+
+
+def test_local_timeout_follows_rtt():
+    session = FakeSession(delay=0.02)
+    # noinspection PyTypeChecker
+    registry = XRegistryLocal(session)
+    device = {"deviceid": "1000123abc", "host": "192.168.1.10"}
+    assert registry.timeout(device) == 1
+
+    async def run():
+        for _ in range(10):
+            assert await registry.send(device, {"switch": "on"}) == "online"
+
+    asyncio.run(run())
+    stats = registry.transport_stats("1000123abc")
+    assert 0.02 <= stats["srtt"] < 0.1
+    assert 0.1 <= registry.timeout(device) < 0.5
+
+    session.errors = [asyncio.TimeoutError()]
+    rto = registry.timeout(device)
+    assert asyncio.run(registry.send(device, {"switch": "on"})) == "timeout"
+    assert registry.timeout(device) == rto * 2
+
+
+def test_local_breaker():
+    session = FakeSession()
+    # noinspection PyTypeChecker
+    registry = XRegistryLocal(session)
+    changes = []
+    registry.dispatcher_connect(SIGNAL_BREAKER, changes.append)
+    device = {"deviceid": "1000123abc", "host": "192.168.1.10"}
+
+    session.errors = [asyncio.TimeoutError()] * 3
+    for _ in range(3):
+        assert asyncio.run(registry.send(device, {"switch": "on"})) == "timeout"
+    assert changes == ["1000123abc"]
+    assert not registry.allow(device)
+
+    stats = registry.transport_stats("1000123abc")
+    assert stats["breaker"] == "open" and stats["health"] == 0
+
+    # after cooldown only one trial request
+    registry.transports["1000123abc"].retry_at = 0
+    assert registry.allow(device)
+    assert not registry.allow(device)
+
+    assert asyncio.run(registry.send(device, {"switch": "on"})) == "online"
+    assert changes == ["1000123abc"] * 2
+    assert registry.allow(device)
+
+
+def test_open_breaker_skips_lan():
+    session = FakeSession()
+    # noinspection PyTypeChecker
+    registry = XRegistry(session)
+    registry.cloud.online = True
+    registry.local.online = True
+    device = {"deviceid": "1000123abc", "host": "192.168.1.10", "online": True}
+    device.update(local=True, localfail=0, params={})
+    registry.devices = {"1000123abc": device}
+
+    cloud = []
+
+    async def send_cloud(device, params=None, *args, **kwargs):
+        cloud.append(params)
+        return "online"
+
+    registry.send_cloud = send_cloud
+
+    session.errors = [asyncio.TimeoutError()] * 3
+    for _ in range(3):
+        asyncio.run(registry.send(device, {"switch": "on"}))
+    assert len(session.requests) == 3
+
+    asyncio.run(registry.send(device, {"switch": "off"}))
+    assert len(session.requests) == 3
+    assert cloud[-1] == {"switch": "off"}
+    # check LAN in background
+    assert device["localping"] == 0
+
+
+def test_requests_by_priority():
+    session = FakeSession(delay=0.01)
+    # noinspection PyTypeChecker
+    registry = XRegistryLocal(session)
+    device = {"deviceid": "1000123abc", "host": "192.168.1.10"}
+
+    async def run():
+        first = asyncio.ensure_future(registry.send(device, {"switch": "on"}))
+        await asyncio.sleep(0)
+        ping = registry.send(device, priority=local.PRIORITY_PING)
+        ping = asyncio.ensure_future(ping)
+        refresh = asyncio.ensure_future(
+            registry.send(device, command="statistics", priority=local.PRIORITY_REFRESH)
+        )
+        command = asyncio.ensure_future(registry.send(device, {"switch": "off"}))
+        return await asyncio.gather(first, ping, refresh, command)
+
+    assert asyncio.run(run()) == ["online"] * 4
+    urls = [url.rsplit("/", 1)[1] for url, _ in session.requests]
+    # the ping isn't needed after the answer to the first command
+    assert urls == ["switch", "switch", "statistics"]
+
+
+def test_waiting_ping_is_dropped():
+    session = FakeSession(delay=0.01)
+    # noinspection PyTypeChecker
+    registry = XRegistryLocal(session)
+    device = {"deviceid": "1000123abc", "host": "192.168.1.10"}
+    data = {"id": "1000123abc", "type": "plug", "seq": "5", "data1": "{}"}
+
+    async def run():
+        first = asyncio.ensure_future(registry.send(device, {"switch": "on"}))
+        await asyncio.sleep(0)
+        ping = registry.send(device, priority=local.PRIORITY_PING)
+        ping = asyncio.ensure_future(ping)
+        await asyncio.sleep(0)
+        # fresh message from the device
+        registry._handler3("1000123abc", "192.168.1.10", data)
+        return await asyncio.gather(first, ping)
+
+    assert asyncio.run(run()) == ["online", "online"]
+    assert len(session.requests) == 1
+
+
+def test_local_liveness():
+    # noinspection PyTypeChecker
+    registry = XRegistry(None)
+    device = {
+        "deviceid": "1000123abc",
+        "extra": {"uiid": 1},
+        "params": {},
+        "local": True,
+        "localfail": 1,
+        "localping": 0,
+        "localrecv": 0,
+    }
+    registry.devices = {"1000123abc": device}
+
+    # unchanged TXT record still counts, mDNS messages make pings less often
+    data = {"id": "1000123abc", "type": "plug", "seq": "5", "data1": "{}"}
+    registry.local.last_txt[("1000123abc", "1000123abc")] = ("5", hash("{}"), None)
+    registry.local._handler3("1000123abc", None, data)
+    assert device["localfail"] == 0
+    assert device["localinterval"] == 118
+    assert 106 <= device["localping"] - time.time() <= 118
+
+    registry.local._handler3("1000123abc", None, data)
+    assert device["localinterval"] == 120
+
+    # the answer to a command doesn't change the interval
+    registry.local.dispatcher_send(SIGNAL_ALIVE, "1000123abc", False)
+    assert device["localinterval"] == 120
+
+    # the ping resets the interval
+    registry.local_pool.create_task = lambda coro, priority: coro.close()
+    registry.update_local(device, device["localping"])
+    assert device["localinterval"] == 59
+
+    # the answer to a ping is routed as update, but without host
+    registry.local_update({"deviceid": "1000123abc", "params": {"switch": "on"}})
+    assert device["localinterval"] == 59
+
+    # unchanged TXT record from the device that failed pings
+    calls = []
+    registry.local.online = True
+    registry.dispatcher_connect("1000123abc", lambda *args: calls.append(args))
+    device["local"] = False
+    device["localfail"] = 3
+    registry.local._handler3("1000123abc", None, data)
+    assert registry.can_local(device)
+    assert device["localfail"] == 0
+    assert calls == [()]
@@ -1,50 +1,117 @@
 import asyncio
 import json
+import time
+from types import SimpleNamespace
 
 from custom_components.sonoff.core.devices import spec
-from custom_components.sonoff.core.ewelink import XDevice, XRegistry, XRegistryLocal
+from custom_components.sonoff.core.entity import XStateWriter
+from custom_components.sonoff.core.ewelink import (
+    XDevice,
+    XRegistry,
+    XRegistryLocal,
+    XTaskPool,
+)
+from custom_components.sonoff.core.ewelink.base import SIGNAL_UPDATE
+from custom_components.sonoff.core.ewelink.cloud import XCloudLimiter, XRegistryCloud
 from custom_components.sonoff.core.ewelink.local import decrypt, encrypt
 from custom_components.sonoff.fan import XFan
 from custom_components.sonoff.light import XLightL1
-from . import DEVICEID, save_to
+from custom_components.sonoff.switch import XSwitch
+from . import DEVICEID, DummyRegistry
 
 
 def test_bulk():
     registry_send = []
 
-    device = XDevice()
+    device = XDevice(params={"configure": [{"outlet": 0, "startup": "off"}]})
     loop = asyncio.new_event_loop()
     # noinspection PyTypeChecker
     registry: XRegistry = XRegistry(None)
-    registry.send = save_to(registry_send)
 
-    loop.create_task(
-        registry.send_bulk(device, {"switches": [{"outlet": 1, "switch": "off"}]})
-    )
-    loop.create_task(
-        registry.send_bulk(device, {"switches": [{"outlet": 2, "switch": "off"}]})
-    )
+    async def send(device: XDevice, params: dict):
+        registry_send.append(params)
+        return "online"
+
+    registry.send = send
+
+    tasks = [
+        loop.create_task(
+            registry.send_bulk(device, {"switches": [{"outlet": 1, "switch": "off"}]})
+        ),
+        loop.create_task(
+            registry.send_bulk(device, {"switches": [{"outlet": 2, "switch": "off"}]})
+        ),
+    ]
     loop.run_until_complete(asyncio.sleep(0))
-    assert device["params_bulk"]["switches"] == [
+    assert device["params_bulk"]["params"]["switches"] == [
         {"outlet": 1, "switch": "off"},
         {"outlet": 2, "switch": "off"},
     ]
 
-    loop.create_task(
-        registry.send_bulk(device, {"switches": [{"outlet": 2, "switch": "off"}]})
-    )
-    loop.create_task(
-        registry.send_bulk(device, {"switches": [{"outlet": 1, "switch": "on"}]})
-    )
+    tasks += [
+        loop.create_task(
+            registry.send_bulk(device, {"switches": [{"outlet": 2, "switch": "off"}]})
+        ),
+        loop.create_task(
+            registry.send_bulk(device, {"switches": [{"outlet": 1, "switch": "on"}]})
+        ),
+        loop.create_task(
+            registry.send_bulk(device, {"configure": [{"outlet": 1, "startup": "on"}]})
+        ),
+    ]
 
-    loop.run_until_complete(asyncio.sleep(0.1))
-    assert registry_send[0][1] == {
-        "switches": [{"outlet": 1, "switch": "on"}, {"outlet": 2, "switch": "off"}]
-    }
+    # all callers wait for one command
+    loop.run_until_complete(asyncio.gather(*tasks))
+    assert registry_send == [
+        {
+            "switches": [{"outlet": 1, "switch": "on"}, {"outlet": 2, "switch": "off"}],
+            # configure starts from the current device list
+            "configure": [
+                {"outlet": 0, "startup": "off"},
+                {"outlet": 1, "startup": "on"},
+            ],
+        }
+    ]
+    assert "params_bulk" not in device
 
     loop.close()
 
 
+def test_bulk_cancel():
+    registry_send = []
+
+    device = XDevice(params={})
+    # noinspection PyTypeChecker
+    registry: XRegistry = XRegistry(None)
+
+    async def send(device: XDevice, params: dict):
+        registry_send.append(params)
+        return "online"
+
+    registry.send = send
+
+    async def run():
+        loop = asyncio.get_event_loop()
+        first = loop.create_task(
+            registry.send_bulk(device, {"switches": [{"outlet": 1, "switch": "off"}]})
+        )
+        second = loop.create_task(
+            registry.send_bulk(device, {"switches": [{"outlet": 2, "switch": "off"}]})
+        )
+        await asyncio.sleep(0)
+
+        # the first caller is cancelled, but the batch is sent for others
+        first.cancel()
+        await second
+        assert first.cancelled()
+
+    asyncio.run(run())
+    assert registry_send == [
+        {"switches": [{"outlet": 1, "switch": "off"}, {"outlet": 2, "switch": "off"}]}
+    ]
+    assert not registry.bulk_tasks
+
+
 def test_issue_1160():
     payload = XRegistryLocal.decrypt_msg(
         {
@@ -64,6 +131,14 @@ def test_issus_1313():
     assert spec(XFan, base="fan")
 
 
+def test_spec_cache():
+    assert spec(XLightL1, base="light") is spec(XLightL1, base="light")
+    assert spec(XFan, channels=[1, 2]) is spec(XFan, channels=[1, 2])
+    assert spec(XFan, channels=[1, 2]) is not spec(XFan, channels=[1, 3])
+    assert spec(XFan, channels=[1, 2]) is not spec(XFan, channels=(1, 2))
+    assert spec(XFan, enabled=False) is not spec(XFan, enabled=True)
+
+
 def test_cryptography():
     params = {"switch": "on"}
     key = "9b0810bc-557a-406c-8266-614767890531"
@@ -75,6 +150,20 @@ def test_cryptography():
     assert json.loads(raw) == params
 
 
+def test_decrypt_msgs():
+    key = "9b0810bc-557a-406c-8266-614767890531"
+    msgs = [
+        encrypt({"data": {"switch": "on"}}, key),
+        encrypt({"data": {"switch": "off"}}, "wrong-key"),
+        {"data": "", "iv": "MTA4MDc1MTQ5NzE5ODE2Ng=="},
+        encrypt({"data": {"switch": "off"}}, key),
+    ]
+    result = XRegistryLocal.decrypt_msgs(msgs, key)
+    assert result[0] == {"switch": "on"}
+    assert isinstance(result[1], Exception)
+    assert result[2:] == [{}, {"switch": "off"}]
+
+
 def test_cloud_zigbee_offline():
     device: XDevice = {
         "online": False,
@@ -89,3 +178,587 @@ def test_cloud_zigbee_offline():
 
     registry.cloud_update({"deviceid": DEVICEID, "params": {"temperature": 0}})
     assert registry.devices[DEVICEID]["online"] is True
+
+
+def test_local_timers():
+    pings = []
+
+    # noinspection PyTypeChecker
+    registry: XRegistry = XRegistry(None)
+    registry.send_local = lambda device, *args: pings.append(device["deviceid"]) or (
+        asyncio.sleep(0)
+    )
+
+    ts = time.time()
+    due = {
+        "deviceid": "1000000001",
+        "extra": {"uiid": 1},
+        "params": {},
+        "local": True,
+        "localfail": 0,
+        "localping": ts - 1,
+        "localrecv": ts - 60,
+    }
+    idle = {**due, "deviceid": "1000000002", "localping": ts + 59, "localrecv": ts}
+    registry.devices = {due["deviceid"]: due, idle["deviceid"]: idle}
+
+    async def run():
+        task = asyncio.get_event_loop().create_task(registry.run_forever())
+        await asyncio.sleep(0.01)
+        assert pings == [due["deviceid"]]
+        # the ping result will be checked after LOCAL_INTERVAL
+        assert due["local_due"] >= ts + 5
+        assert idle["local_due"] == idle["localping"]
+
+        # instant ping request wakes up the loop
+        registry.ping_local(idle)
+        await asyncio.sleep(0.01)
+        assert pings == [due["deviceid"], idle["deviceid"]]
+
+        task.cancel()
+
+    asyncio.run(run())
+
+
+def test_task_pool():
+    pool = XTaskPool(1)
+    order = []
+
+    async def job(name: str):
+        order.append(name)
+        await asyncio.sleep(0.01)
+
+    async def run():
+        pool.create_task(job("first"), 3)
+        pool.create_task(job("ping"), 3)
+        pool.create_task(job("refresh"), 2)
+        await asyncio.sleep(0)
+        assert pool.stats() == {"limit": 1, "in_flight": 1, "queued": 2}
+
+        # user command doesn't wait for the queue
+        await pool.run(job("command"), 0)
+        assert order == ["first", "command"]
+
+        await asyncio.sleep(0.05)
+        assert order == ["first", "command", "refresh", "ping"]
+        assert pool.stats() == {"limit": 1, "in_flight": 0, "queued": 0}
+
+        pool.create_task(job("long"), 3)
+        pool.create_task(job("cancelled"), 3)
+        await asyncio.sleep(0)
+        pool.cancel()
+        await asyncio.sleep(0)
+        assert pool.stats() == {"limit": 1, "in_flight": 0, "queued": 0}
+        assert order[-1] == "long"
+
+        # zero limit from options still leaves one slot for background jobs
+        pool.limit = 0
+        await asyncio.wait_for(pool.run(job("zero"), 1), 1)
+        assert pool.stats() == {"limit": 1, "in_flight": 0, "queued": 0}
+
+    asyncio.run(run())
+
+
+def test_dispatcher_keys():
+    calls = []
+
+    # noinspection PyTypeChecker
+    registry: XRegistry = XRegistry(None)
+    registry.cloud.online = True
+    device = {"deviceid": DEVICEID, "online": True, "params": {}}
+    registry.devices = {DEVICEID: device}
+
+    registry.dispatcher_connect(DEVICEID, lambda p: calls.append("any"))
+    registry.dispatcher_connect(DEVICEID, lambda p: calls.append("a"), {"a", "b"})
+    registry.dispatcher_connect(DEVICEID, lambda p: calls.append("c"), {"c"})
+    registry.dispatcher_connect(DEVICEID, lambda p: calls.append("child"), set())
+
+    registry.cloud_update({"deviceid": DEVICEID, "params": {"a": 1, "b": 2}})
+    assert calls == ["any", "a"]
+
+    calls.clear()
+    registry.cloud_update({"deviceid": DEVICEID, "params": {"d": 1}})
+    assert calls == ["any"]
+
+    # availability change should be sent to all targets
+    calls.clear()
+    registry.cloud_update({"deviceid": DEVICEID, "params": {"online": False}})
+    assert calls == ["any", "a", "c", "child"]
+
+
+def test_duplicate_updates():
+    calls = []
+
+    # noinspection PyTypeChecker
+    registry: XRegistry = XRegistry(None)
+    registry.cloud.online = True
+    device = {
+        "deviceid": DEVICEID,
+        "extra": {"uiid": 1},
+        "online": True,
+        "host": "192.168.1.10",
+        "params": {"host": "192.168.1.10"},
+    }
+    registry.devices = {DEVICEID: device}
+    registry.dispatcher_connect(DEVICEID, lambda p: calls.append(p))
+
+    local = {
+        "deviceid": DEVICEID,
+        "host": "192.168.1.10",
+        "params": {"switch": "on"},
+        "seq": "10",
+    }
+    registry.local_update(dict(local, params={"switch": "on"}))
+    # mDNS repeat of the same message
+    registry.local_update(dict(local, params={"switch": "on"}))
+    # cloud echo of the same change
+    registry.cloud_update({"deviceid": DEVICEID, "params": {"switch": "on"}})
+    assert calls == [{"switch": "on"}]
+    # duplicates still count as device activity
+    assert device["local"] is True
+
+    # stale local update
+    registry.local_update(dict(local, params={"switch": "off"}, seq="9"))
+    assert device["params"]["switch"] == "on"
+
+    registry.local_update(dict(local, params={"switch": "off"}, seq="11"))
+    registry.cloud_update({"deviceid": DEVICEID, "params": {"switch": "on"}})
+    assert calls == [{"switch": "on"}, {"switch": "off"}, {"switch": "on"}]
+    assert device["local_seq"] == "11"
+
+
+def test_duplicate_updates_subdevices():
+    calls = []
+
+    # noinspection PyTypeChecker
+    registry: XRegistry = XRegistry(None)
+    device = {
+        "deviceid": DEVICEID,
+        "extra": {"uiid": 128},
+        "host": "192.168.1.10",
+        "params": {"host": "192.168.1.10"},
+    }
+    registry.devices = {DEVICEID: device}
+    registry.dispatcher_connect("a480000001", lambda p: calls.append(p))
+    registry.dispatcher_connect("a480000002", lambda p: calls.append(p))
+
+    local = {"deviceid": DEVICEID, "host": "192.168.1.10"}
+    registry.local_update(
+        dict(local, subdevid="a480000001", params={"current_00": 1}, seq="20")
+    )
+    # SPM-Main children have their own sequence counters
+    registry.local_update(
+        dict(local, subdevid="a480000002", params={"current_00": 2}, seq="5")
+    )
+    assert calls == [{"current_00": 1}, {"current_00": 2}]
+
+    # but a lower sequence of the same child is stale
+    registry.local_update(
+        dict(local, subdevid="a480000002", params={"current_00": 3}, seq="4")
+    )
+    assert calls == [{"current_00": 1}, {"current_00": 2}]
+
+
+def test_resync_cloud():
+    calls = []
+
+    # noinspection PyTypeChecker
+    registry: XRegistry = XRegistry(None)
+    registry.cloud.online = True
+    device = {
+        "deviceid": DEVICEID,
+        "extra": {"uiid": 1},
+        "online": True,
+        "params": {"switch": "on", "rssi": -50},
+    }
+    registry.devices = {DEVICEID: device}
+    registry.dispatcher_connect(DEVICEID, lambda p: calls.append(p))
+
+    async def get_devices(homes):
+        return [
+            {
+                "deviceid": DEVICEID,
+                "online": True,
+                "params": {"switch": "off", "rssi": -50},
+            },
+            {"deviceid": "1000123abd", "online": True, "params": {}},
+        ]
+
+    registry.cloud.get_devices = get_devices
+
+    new = asyncio.run(registry.resync_cloud())
+    assert [i["deviceid"] for i in new] == ["1000123abd"]
+    assert calls == [{"switch": "off"}]
+    assert device["params"] == {"switch": "off", "rssi": -50}
+    assert registry.cloud_resync is False
+
+    # nothing changed
+    asyncio.run(registry.resync_cloud())
+    assert calls == [{"switch": "off"}]
+
+
+def test_get_devices_homes_in_parallel():
+    active = [0, 0]  # now, max
+
+    class Response:
+        def __init__(self, home: str):
+            self.home = home
+
+        async def json(self):
+            items = [{"itemData": {"deviceid": self.home}}, {"itemData": {}}]
+            return {"error": 0, "data": {"thingList": items}}
+
+    class Session:
+        async def get(self, url: str, headers: dict, timeout: float, params: dict):
+            active[0] += 1
+            active[1] = max(active)
+            await asyncio.sleep(0.01)
+            active[0] -= 1
+            return Response(params["familyid"])
+
+    # noinspection PyTypeChecker
+    cloud = XRegistryCloud(Session())
+    cloud.region = "eu"
+    cloud.auth = {"at": ""}
+
+    devices = asyncio.run(cloud.get_devices(["h1", "h2", "h3"]))
+    assert [i["deviceid"] for i in devices] == ["h1", "h2", "h3"]
+    assert active == [0, 3]
+
+
+def test_setup_children():
+    # noinspection PyTypeChecker
+    registry = XRegistry(None)
+    children = [
+        {
+            "deviceid": f"a48000{i:04}",
+            "name": f"Child{i}",
+            "extra": {"uiid": 7000},
+            "params": {"parentid": DEVICEID},
+        }
+        for i in range(3)
+    ]
+    parent = {
+        "deviceid": DEVICEID,
+        "name": "Bridge",
+        "extra": {"uiid": 66},
+        "params": {},
+    }
+    registry.setup_devices(children + [parent])
+
+    assert registry.children == {DEVICEID: children}
+    assert all(child["parent"] is parent for child in children)
+    assert list(registry.devices)[0] == DEVICEID
+
+
+def test_restore_available():
+    # same order as async_setup_entry: restoring is set before setup_devices
+    reg = DummyRegistry()
+    reg.restoring = True
+    device = {
+        "deviceid": DEVICEID,
+        "name": "Device1",
+        "online": True,
+        "extra": {"uiid": 1},
+        "params": {"switch": "on"},
+    }
+    switch: XSwitch = reg.setup_devices([device])[0]
+
+    # transports are not started yet, last known availability from cache
+    assert switch.available
+
+    reg.restore_done()
+    assert not switch.available
+
+    reg.cloud.online = True
+    reg.dispatcher_send(DEVICEID)
+    assert switch.available
+
+
+def test_redundant_command():
+    # noinspection PyTypeChecker
+    registry: XRegistry = XRegistry(None)
+    registry.cloud.online = True
+    device = {
+        "deviceid": DEVICEID,
+        "extra": {"uiid": 1},
+        "online": True,
+        "params": {},
+    }
+    registry.devices = {DEVICEID: device}
+
+    # unknown state
+    on = {"switches": [{"outlet": 1, "switch": "on"}]}
+    assert not registry.is_redundant_command(device, on)
+
+    registry.cloud_update(
+        {
+            "deviceid": DEVICEID,
+            "params": {
+                "switches": [
+                    {"outlet": 0, "switch": "off"},
+                    {"outlet": 1, "switch": "on"},
+                ]
+            },
+        }
+    )
+    assert registry.is_redundant_command(device, on)
+    assert not registry.is_redundant_command(
+        device, {"switches": [{"outlet": 0, "switch": "on"}]}
+    )
+    # not idempotent
+    assert not registry.is_redundant_command(device, {"pulse": "on"})
+
+    asyncio.run(registry.send(device, on))
+    assert registry.redundant_stats == {"skipped": 1, "sent": 0}
+
+    # state is not confirmed after a command
+    registry.cloud.online = False
+    asyncio.run(registry.send(device, {"switches": [{"outlet": 0, "switch": "on"}]}))
+    assert not registry.is_redundant_command(device, on)
+    assert registry.redundant_stats == {"skipped": 1, "sent": 1}
+
+    # old state
+    device["command_ts"] = 0
+    device["state_ts"] = time.monotonic() - 61
+    assert not registry.is_redundant_command(device, on)
+
+    # telemetry between a command and its confirmation doesn't confirm it
+    registry.cloud.online = True
+    registry.cloud_update({"deviceid": DEVICEID, "params": {"switch": "on"}})
+    registry.cloud.online = False
+    asyncio.run(registry.send(device, {"switch": "off"}))
+    registry.cloud_update({"deviceid": DEVICEID, "params": {"power": "12.5"}})
+    assert not registry.is_redundant_command(device, {"switch": "on"})
+
+
+def test_decrypt_local():
+    calls = []
+    key = "9b0810bc-557a-406c-8266-614767890531"
+
+    # noinspection PyTypeChecker
+    registry: XRegistry = XRegistry(None)
+    registry.local_decrypt = True
+    device = {
+        "deviceid": DEVICEID,
+        "devicekey": key,
+        "extra": {"uiid": 1},
+        "host": "192.168.1.10",
+        "params": {},
+    }
+    registry.devices = {DEVICEID: device}
+    registry.dispatcher_connect(DEVICEID, lambda p: calls.append(p))
+
+    async def run():
+        for i in range(5):
+            msg = encrypt({"data": {"switch": "on", "i": i}}, key)
+            msg.update(deviceid=DEVICEID, host="192.168.1.10", seq=str(i))
+            registry.local_update(msg)
+        assert calls == []
+        assert len(registry.decrypt_pending[DEVICEID]) == 5
+
+        for _ in range(10):
+            await asyncio.sleep(0.01)
+            if not registry.decrypt_pending:
+                break
+
+    asyncio.run(run())
+    assert [p["i"] for p in calls] == [0, 1, 2, 3, 4]
+    assert device["local_seq"] == "4"
+    assert device["devicekey"] == key
+
+
+def test_decrypt_local_full():
+    key = "9b0810bc-557a-406c-8266-614767890531"
+
+    # noinspection PyTypeChecker
+    registry: XRegistry = XRegistry(None)
+    registry.local_decrypt = True
+    device = {
+        "deviceid": DEVICEID,
+        "devicekey": key,
+        "extra": {"uiid": 1},
+        "params": {},
+    }
+    registry.devices = {DEVICEID: device}
+    registry.decrypt_pending = {"1000123abd": [{}] * 256}
+    registry.local.last_txt[(DEVICEID, DEVICEID)] = ("1", 0, "192.168.1.10")
+
+    msg = encrypt({"data": {"switch": "on"}}, key)
+    msg.update(
+        deviceid=DEVICEID,
+        subdevid=DEVICEID,
+        host="192.168.1.10",
+        localtype="plug",
+        seq="1",
+    )
+    registry.local_update(msg)
+
+    # the message is dropped, but its repeat won't be skipped and the device
+    # will be pinged for the state
+    assert DEVICEID not in registry.decrypt_pending
+    assert (DEVICEID, DEVICEID) not in registry.local.last_txt
+    assert device["host"] == "192.168.1.10"
+    assert device["local"] is False
+    assert device["localping"] == 0
+    assert registry.local_timers == [(0, DEVICEID)]
+
+
+def test_hedged_send():
+    calls = []
+
+    # noinspection PyTypeChecker
+    registry: XRegistry = XRegistry(None)
+    registry.hedged = True
+    registry.cloud.online = True
+    registry.local.online = True
+    registry.local.hedge_delay = lambda device: 0.01
+    device = {"deviceid": DEVICEID, "online": True, "local": True, "params": {}}
+
+    local_result = ["online", 0.05]
+
+    async def local_send(device, params, command, sequence, timeout=5, priority=0):
+        calls.append(("local", params))
+        await asyncio.sleep(local_result[1])
+        return local_result[0]
+
+    async def send_cloud(device, params=None, query=True, *args, **kwargs):
+        calls.append(("cloud", params, query))
+        return "online"
+
+    registry.local.send = local_send
+    registry.send_cloud = send_cloud
+
+    async def run(params: dict):
+        calls.clear()
+        ts = time.monotonic()
+        await registry.send(device, params)
+        elapsed = time.monotonic() - ts
+        await asyncio.gather(*registry.hedge_tasks)
+        return elapsed
+
+    # LAN is late, Cloud answers first, no Cloud query after LAN confirmation
+    assert asyncio.run(run({"switch": "on"})) < 0.04
+    assert calls == [("local", {"switch": "on"}), ("cloud", {"switch": "on"}, False)]
+
+    # LAN fails, the Cloud query is sent after the Cloud command
+    local_result[0] = "timeout"
+    asyncio.run(run({"switch": "off"}))
+    assert calls[-1] == ("cloud", None, True)
+
+    # unsafe command waits for LAN before Cloud
+    asyncio.run(run({"brightness": 50}))
+    assert calls == [("local", {"brightness": 50}), ("cloud", {"brightness": 50}, True)]
+
+    async def cancel():
+        calls.clear()
+        task = asyncio.get_event_loop().create_task(
+            registry.send(device, {"switch": "on"})
+        )
+        await asyncio.sleep(0.005)
+        task.cancel()
+        await asyncio.sleep(0)
+        # the LAN request and its completion stay tracked for registry stop
+        assert task.cancelled()
+        assert len(registry.hedge_tasks) == 2
+        await asyncio.gather(*registry.hedge_tasks)
+
+    # the caller is cancelled while it waits for LAN
+    local_result[:] = ["online", 0.02]
+    asyncio.run(cancel())
+    assert calls == [("local", {"switch": "on"})]
+    assert not registry.hedge_tasks
+
+
+def test_cloud_limiter():
+    order = []
+
+    async def request(limiter: XCloudLimiter, deviceid: str, priority: int):
+        await limiter.acquire(deviceid, priority)
+        order.append(deviceid)
+
+    async def run():
+        limiter = XCloudLimiter(rate=100, burst=1)
+        loop = asyncio.get_event_loop()
+        tasks = [
+            loop.create_task(request(limiter, deviceid, 3))
+            for deviceid in ("poll1", "poll1", "poll1", "poll2")
+        ]
+        await asyncio.sleep(0)
+        tasks.append(loop.create_task(request(limiter, "user", 0)))
+        await asyncio.gather(*tasks)
+        assert limiter.stats()["queued"] == {}
+
+    asyncio.run(run())
+    # user action before polls, polls take turns by device
+    assert order == ["poll1", "user", "poll1", "poll2", "poll1"]
+
+
+def test_cloud_ws_frames():
+    msgs = []
+
+    # noinspection PyTypeChecker
+    cloud = XRegistryCloud(None)
+    cloud.dispatcher_connect(SIGNAL_UPDATE, lambda msg: msgs.append(msg["params"]))
+
+    # frames are processed in the order they came, without tasks
+    for i in range(3):
+        ts = time.monotonic()
+        cloud._process_ws_msg({"action": "update", "deviceid": DEVICEID, "params": i})
+        cloud._update_ws_stats(ts)
+    assert msgs == [0, 1, 2]
+    assert cloud.ws_stats["frames"] == 3
+
+    cloud.ws_window = (time.monotonic() - 1, 9, 0.002)
+    cloud._update_ws_stats(time.monotonic())
+    assert 9 <= cloud.ws_stats["frames_per_sec"] <= 10
+    assert cloud.ws_stats["lag_ms"] == 2
+
+
+def test_cloud_response_waiters():
+    # noinspection PyTypeChecker
+    cloud1, cloud2 = XRegistryCloud(None), XRegistryCloud(None)
+
+    async def run():
+        assert await cloud1._wait_response("1", 0.01) == "timeout"
+        assert cloud1._waiters == {}
+
+        task = asyncio.ensure_future(cloud1._wait_response("2", 5))
+        await asyncio.sleep(0)
+        # registries don't share sequences
+        assert not cloud2._set_response("2", 0)
+        assert cloud1._set_response("2", 0)
+        assert await task == "online"
+
+        # connection lost, don't wait timeouts
+        tasks = [asyncio.ensure_future(cloud1._wait_response(i, 5)) for i in "34"]
+        await asyncio.sleep(0)
+        cloud1._fail_responses()
+        assert await asyncio.gather(*tasks) == ["timeout", "timeout"]
+        assert cloud1._waiters == {}
+
+    asyncio.run(run())
+
+
+def test_state_writer():
+    writes = []
+
+    class Entity:
+        def __init__(self):
+            self.hass = SimpleNamespace(loop=asyncio.get_event_loop())
+
+        def _async_write_ha_state(self):
+            writes.append(self)
+
+    async def run():
+        writer = XStateWriter()
+        entity1, entity2 = Entity(), Entity()
+        writer.schedule(entity1, 0)
+        writer.schedule(entity2, 0)
+        writer.schedule(entity1, 0)
+        assert writes == []
+
+        await asyncio.sleep(0)
+        assert writes == [entity1, entity2]
+
+    asyncio.run(run())